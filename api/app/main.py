@@ -1,13 +1,38 @@
 import os
+import re
+import sys
+import json
+import asyncio
+import time
 import base64
+import contextvars
+import csv
+import difflib
+import heapq
+import io
 import mimetypes
+import threading
+import multiprocessing
+import tempfile
 import subprocess
+import socket
+import sqlite3
+import uuid
+import cProfile
+import hmac
+import pstats
 from typing import List
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, date, timedelta
+from urllib.parse import quote
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool as _run_in_threadpool
 from pydantic import BaseModel
 
 from email.mime.text import MIMEText
@@ -19,14 +44,27 @@ from docx import Document
 from docx.shared import Pt
 from docx.oxml.ns import qn
 
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 try:
     import boto3
-    from botocore.exceptions import BotoCoreError, ClientError
+    from botocore.config import Config as BotoConfig
+    from botocore.auth import S3SigV4Auth
+    from botocore.awsrequest import AWSRequest
+    from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 except Exception:  # boto3 optional for local use
-    boto3 = None
-    BotoCoreError = ClientError = Exception
+    boto3 = BotoConfig = S3SigV4Auth = AWSRequest = None
+    BotoCoreError = ClientError = NoCredentialsError = Exception
+try:
+    import httpx
+except Exception:  # without httpx Gmail and S3 always use the sync clients
+    httpx = None
+try:
+    import pikepdf
+except Exception:  # PDF post-processing is skipped without pikepdf
+    pikepdf = None
 
 # ---------------- Config ----------------
 PEN_EMAIL = os.getenv('PEN_EMAIL', 'office@pen.com')
@@ -34,12 +72,22 @@ PEN_EMAIL = os.getenv('PEN_EMAIL', 'office@pen.com')
 TEST_EMAIL = os.getenv('TEST_EMAIL', 'luqmanmirajdeen@gmail.com')
 EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS', 'your_email@example.com')
 TOKEN_FILE = os.getenv('TOKEN_FILE', 'token.json')
+# Point the Gmail client at another server (e.g. the loadtest.py stub); the token is optional then
+GMAIL_API_URL = os.getenv('GMAIL_API_URL')
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 FINISHED_DIR = os.path.join(BASE_DIR, 'finished_noms')
 os.makedirs(FINISHED_DIR, exist_ok=True)
 
+# finished_noms layout: <type>/<YYYY>/<MM>/<file>; files from before sharding stay readable flat
+STORAGE_SHARDED = os.getenv('STORAGE_SHARDED', '1') == '1'
+# Janitor: 0 disables a limit. RETENTION_REQUIRE_S3 only deletes files already in S3.
+JANITOR_INTERVAL = float(os.getenv('JANITOR_INTERVAL', '3600'))  # seconds, 0 = no janitor
+RETENTION_DAYS = float(os.getenv('RETENTION_DAYS', '0'))
+RETENTION_MAX_MB = float(os.getenv('RETENTION_MAX_MB', '0'))
+RETENTION_REQUIRE_S3 = os.getenv('RETENTION_REQUIRE_S3', '0') == '1'
+
 MGO_TEMPLATE = os.getenv('MGO_TEMPLATE', os.path.join(BASE_DIR, 'mgo_nom_template.docx'))
 IFO_TEMPLATE = os.getenv('IFO_TEMPLATE', os.path.join(BASE_DIR, 'ifo_nom_template.docx'))
 BOTH_TEMPLATE = os.getenv('BOTH_TEMPLATE', os.path.join(BASE_DIR, 'mgo_ifo_nom_template.docx'))
@@ -51,13 +99,105 @@ BOTH_INVOICE_TEMPLATE = os.getenv('BOTH_INVOICE_TEMPLATE', os.path.join(BASE_DIR
 
 LIBREOFFICE_PATH = os.getenv('LIBREOFFICE_PATH', r'C:\\Program Files\\LibreOffice\\program\\soffice.exe')
 
+# PDF export profile (LibreOffice writer_pdf_Export options). Embedded fonts
+# are always subsetted by LibreOffice; the profiles control images and PDF/A.
+PDF_PROFILE = os.getenv('PDF_PROFILE', 'default')
+PDF_POSTPROCESS = os.getenv('PDF_POSTPROCESS', '1') == '1'
+PDF_PROFILES = {
+    'default': {},
+    'compact': {
+        'ReduceImageResolution': True,
+        'MaxImageResolution': 150,
+        'UseLosslessCompression': False,
+        'Quality': 70,
+        'EmbedStandardFonts': False,
+    },
+    'print': {
+        'ReduceImageResolution': True,
+        'MaxImageResolution': 300,
+        'UseLosslessCompression': False,
+        'Quality': 90,
+    },
+    'archive': {
+        'SelectPdfVersion': 2,  # PDF/A-2b
+        'UseLosslessCompression': True,
+    },
+}
+
 
 DISABLE_EMAIL = os.getenv('DISABLE_EMAIL', '0') == '1'
 
+# Opt-in digest mode: coalesce emails per recipient set
+EMAIL_DIGEST = os.getenv('EMAIL_DIGEST', '0') == '1'
+EMAIL_DIGEST_WINDOW = float(os.getenv('EMAIL_DIGEST_WINDOW', '300'))  # seconds
+EMAIL_DIGEST_MAX_ATTACHMENTS = int(os.getenv('EMAIL_DIGEST_MAX_ATTACHMENTS', '20'))
+EMAIL_DIGEST_MAX_BYTES = int(float(os.getenv('EMAIL_DIGEST_MAX_MB', '20')) * 1024 * 1024)
+EMAIL_DIGEST_RETRIES = int(os.getenv('EMAIL_DIGEST_RETRIES', '5'))  # resends of a failed digest
+EMAIL_DIGEST_RETRY_DELAY = float(os.getenv('EMAIL_DIGEST_RETRY_DELAY', '30'))  # seconds, doubled per attempt
+# Message types that always go out immediately
+EMAIL_URGENT_TYPES = {t.strip() for t in os.getenv('EMAIL_URGENT_TYPES', 'final_nomination').split(',') if t.strip()}
+
 # S3 config (optional). If S3_BUCKET is set, generated files will be uploaded.
 S3_BUCKET = os.getenv('S3_BUCKET')
 S3_PREFIX = os.getenv('S3_PREFIX', 'noms/')
 S3_REGION = os.getenv('AWS_REGION') or os.getenv('AWS_DEFAULT_REGION') or 'us-east-1'
+# S3-compatible server instead of AWS (MinIO, the loadtest.py stub, ...)
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+
+# Post-render stages (email, S3, ledger) run in parallel, each with its own timeout (seconds)
+LEDGER_FILE = os.getenv('LEDGER_FILE', os.path.join(BASE_DIR, 'ledger.jsonl'))
+EMAIL_TIMEOUT = float(os.getenv('EMAIL_TIMEOUT', '30'))
+S3_TIMEOUT = float(os.getenv('S3_TIMEOUT', '60'))
+LEDGER_TIMEOUT = float(os.getenv('LEDGER_TIMEOUT', '5'))
+STAGE_WORKERS = int(os.getenv('STAGE_WORKERS', '8'))
+
+# Gmail and S3 over one pooled async HTTP client (ASYNC_IO=0: googleapiclient/boto3 in threads)
+ASYNC_IO = os.getenv('ASYNC_IO', '1') == '1' and httpx is not None
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', '200'))
+ASYNC_KEEPALIVE = int(os.getenv('ASYNC_KEEPALIVE', '50'))  # idle connections kept open
+# Connections per client; more connections are spread over several clients, because
+# httpcore scans the whole pool for every request and slows down with large pools
+ASYNC_POOL_SIZE = int(os.getenv('ASYNC_POOL_SIZE', '16'))
+
+# Customer statements: invoice lines listed in the document itself (all lines go to the CSV)
+STATEMENT_MAX_LINES = int(os.getenv('STATEMENT_MAX_LINES', '500'))
+
+# Fleet nominations render on a process pool
+FLEET_WORKERS = int(os.getenv('FLEET_WORKERS', str(os.cpu_count() or 2)))
+FLEET_MAX_VESSELS = int(os.getenv('FLEET_MAX_VESSELS', '100'))
+FLEET_RENDER_TIMEOUT = float(os.getenv('FLEET_RENDER_TIMEOUT', '300'))
+
+# Speculative nomination drafts pre-rendered from /initial-request
+PRERENDER_DRAFTS = os.getenv('PRERENDER_DRAFTS', '1') == '1'
+DRAFTS_DIR = os.getenv('DRAFTS_DIR', os.path.join(BASE_DIR, 'drafts'))
+DRAFT_TTL = float(os.getenv('DRAFT_TTL', str(3 * 24 * 3600)))  # seconds
+DRAFT_MAX = int(os.getenv('DRAFT_MAX', '200'))
+DRAFT_QUEUE_MAX = int(os.getenv('DRAFT_QUEUE_MAX', '20'))
+
+# Shared state for several workers on one host: 'sqlite' (default) or 'memory' (single process).
+# The database must be on local disk; SQLite's WAL mode does not work over NFS/EFS.
+SHARED_STATE = os.getenv('SHARED_STATE', 'sqlite')
+SHARED_STATE_DB = os.getenv('SHARED_STATE_DB', os.path.join(BASE_DIR, 'shared_state.db'))
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', str(24 * 3600)))  # seconds a response is replayed
+
+# Vessel registry: IMO -> name/flag, filled by CSV import, used to auto-fill requests
+VESSEL_DB = os.getenv('VESSEL_DB', os.path.join(BASE_DIR, 'vessels.db'))
+VESSEL_CACHE_SIZE = int(os.getenv('VESSEL_CACHE_SIZE', '4096'))
+VESSEL_CACHE_TTL = float(os.getenv('VESSEL_CACHE_TTL', '300'))  # seconds, bounds staleness after another worker imports
+
+# On-demand request profiling. With PROFILING=0 no hook is installed at all.
+PROFILING = os.getenv('PROFILING', '0') == '1'
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))  # newest profiles kept on disk
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))  # seconds
+# Required in X-Admin-Token for /admin/*, /vessels/import and X-Profile; unset = those are refused
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Request tracing: one JSONL line per request with its spans, rotated by size
+TRACING = os.getenv('TRACING', '1') == '1'
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(BASE_DIR, 'traces.jsonl'))
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', str(20 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv('TRACE_BACKUPS', '3'))  # rotated files kept: traces.jsonl.1 ... .N
 
 _s3_client = None
 def get_s3_client():
@@ -67,24 +207,405 @@ def get_s3_client():
     if boto3 is None:
         return None
     if _s3_client is None:
-        _s3_client = boto3.client('s3', region_name=S3_REGION)
+        if S3_ENDPOINT_URL:
+            _s3_client = boto3.client(
+                's3',
+                region_name=S3_REGION,
+                endpoint_url=S3_ENDPOINT_URL,
+                config=BotoConfig(s3={'addressing_style': 'path'}),
+            )
+        else:
+            _s3_client = boto3.client('s3', region_name=S3_REGION)
     return _s3_client
 
+# ---------------- Tracing ----------------
+# Each request gets a correlation id (X-Request-ID, taken from the caller when sent).
+# span() records timed steps with attributes into the current request's trace;
+# outside a request, or with TRACING=0, it only hands back a scratch dict.
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+_trace_file_lock = threading.Lock()
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace['trace_id'] if trace else None
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a step of the current request; the yielded dict takes extra attributes"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    span_id = uuid.uuid4().hex[:16]
+    token = _current_span.set(span_id)
+    started = time.time()
+    error = None
+    try:
+        yield attrs
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _current_span.reset(token)
+        record = {
+            'span_id': span_id,
+            'parent_id': _current_span.get(),
+            'name': name,
+            'start': round(started, 6),
+            'duration_ms': round((time.time() - started) * 1000, 3),
+            'thread': threading.current_thread().name,
+            'attrs': attrs,
+        }
+        if error:
+            record['error'] = error
+        with trace['lock']:
+            trace['spans'].append(record)
+
+
+def start_trace(trace_id=None, **attrs):
+    """Begin a trace in the current context; returns it for finish_trace"""
+    trace = {
+        'trace_id': trace_id or uuid.uuid4().hex,
+        'start': time.time(),
+        'attrs': attrs,
+        'spans': [],
+        'lock': threading.Lock(),
+    }
+    trace['token'] = _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace, **attrs):
+    """Close the trace; returns its record for save_trace"""
+    _current_trace.reset(trace['token'])
+    record = {
+        'trace_id': trace['trace_id'],
+        'worker': WORKER_ID,
+        'start': round(trace['start'], 6),
+        'duration_ms': round((time.time() - trace['start']) * 1000, 3),
+        'attrs': {**trace['attrs'], **attrs},
+        'spans': sorted(trace['spans'], key=lambda s: s['start']),
+    }
+    return record
+
+
+def save_trace(record):
+    """Append a finished trace to TRACE_FILE; blocks while another worker rotates it"""
+    try:
+        write_trace(record)
+    except (OSError, TimeoutError) as e:
+        print(f"[TRACE] Could not write trace {record['trace_id']}: {e}")
+
+
+def write_trace(record):
+    line = json.dumps(record, default=str) + '\n'
+    with _trace_file_lock:
+        try:
+            full = os.path.getsize(TRACE_FILE) + len(line) > TRACE_MAX_BYTES
+        except OSError:
+            full = False
+        if full:
+            with shared.lock('trace-rotate'):
+                # Another worker may have rotated already
+                if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) + len(line) > TRACE_MAX_BYTES:
+                    for i in range(TRACE_BACKUPS - 1, 0, -1):
+                        if os.path.exists(f'{TRACE_FILE}.{i}'):
+                            os.replace(f'{TRACE_FILE}.{i}', f'{TRACE_FILE}.{i + 1}')
+                    if TRACE_BACKUPS > 0:
+                        os.replace(TRACE_FILE, f'{TRACE_FILE}.1')
+                    else:
+                        os.remove(TRACE_FILE)
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def read_traces():
+    """All traces on disk, oldest file first"""
+    paths = [f'{TRACE_FILE}.{i}' for i in range(TRACE_BACKUPS, 0, -1)] + [TRACE_FILE]
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a crash
+
+
+def slowest_traces(limit=20, since=None, path=None):
+    """The slowest traces, optionally only newer than `since` (epoch seconds) or for one path"""
+    traces = (
+        t for t in read_traces()
+        if (since is None or t['start'] >= since) and (path is None or t['attrs'].get('path') == path)
+    )
+    return heapq.nlargest(limit, traces, key=lambda t: t['duration_ms'])
+
+
+# cProfile only sees the thread it was enabled in. While a request is profiled,
+# work it hands to a thread gets a profiler of its own, merged into the capture.
+_current_profile = contextvars.ContextVar('profile', default=None)
+
+
+def profiled(fn):
+    """fn, wrapped to be profiled with the current request when it is being profiled"""
+    capture = _current_profile.get()
+    if capture is None:
+        return fn
+
+    def run(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+: the request's profiler already sees every thread
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with capture['lock']:
+                capture['threads'].append(profiler)
+    return run
+
+
+async def run_in_threadpool(fn, *args, **kwargs):
+    """fastapi's run_in_threadpool, profiled along with the request"""
+    return await _run_in_threadpool(profiled(fn), *args, **kwargs)
+
+
+# ---------------- Shared state ----------------
+# Render cache entries, job claims and idempotency keys live here so every
+# uvicorn worker on this host sees them. Draft paths in it are host-local.
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+class MemoryState:
+    """Process-local state, for a single worker"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}  # namespace -> {key: [value, expires, touched]}
+        self._locks = {}
+
+    def _live(self, namespace):
+        now = time.time()
+        entries = self._data.setdefault(namespace, {})
+        for key in [k for k, e in entries.items() if e[1] is not None and e[1] < now]:
+            del entries[key]
+        return entries
+
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._live(namespace).get(key)
+            return None if entry is None else entry[0]
+
+    def put(self, namespace, key, value, ttl=None):
+        with self._lock:
+            self._live(namespace)[key] = [value, time.time() + ttl if ttl else None, time.time()]
+
+    def add(self, namespace, key, value, ttl=None):
+        """Store only if the key is absent; True when stored"""
+        with self._lock:
+            if key in self._live(namespace):
+                return False
+            self.put(namespace, key, value, ttl)
+            return True
+
+    def touch(self, namespace, key):
+        with self._lock:
+            entry = self._live(namespace).get(key)
+            if entry is not None:
+                entry[2] = time.time()
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._live(namespace).pop(key, None)
+
+    def items(self, namespace):
+        """(key, value) pairs, least recently touched first"""
+        with self._lock:
+            entries = sorted(self._live(namespace).items(), key=lambda item: item[1][2])
+            return [(k, e[0]) for k, e in entries]
+
+    def claim(self, name, ttl):
+        with self._lock:
+            holder = self.get('claims', name)
+            if holder is not None and holder != WORKER_ID:
+                return False
+            self.put('claims', name, WORKER_ID, ttl)
+            return True
+
+    def release(self, name):
+        with self._lock:
+            if self.get('claims', name) == WORKER_ID:
+                self.delete('claims', name)
+
+    def purge(self):
+        with self._lock:
+            for namespace in list(self._data):
+                self._live(namespace)
+
+    @contextmanager
+    def lock(self, name, timeout=30):
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        if not lock.acquire(timeout=timeout):
+            raise TimeoutError(f'Could not lock {name}')
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+class SqliteState(MemoryState):
+    """State shared by all processes using the same SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._thread_locks = {}
+        self._guard = threading.Lock()
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS kv ('
+                'namespace TEXT, key TEXT, value TEXT, expires REAL, touched REAL, '
+                'PRIMARY KEY (namespace, key))'
+            )
+
+    def _connect(self):
+        # One connection per thread, and never one inherited across fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def get(self, namespace, key):
+        row = self._connect().execute(
+            'SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires >= ?)',
+            (namespace, key, time.time()),
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, namespace, key, value, ttl=None):
+        now = time.time()
+        self._connect().execute(
+            'INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?, ?)',
+            (namespace, key, json.dumps(value, default=str), now + ttl if ttl else None, now),
+        )
+
+    def add(self, namespace, key, value, ttl=None):
+        now = time.time()
+        cursor = self._connect().execute(
+            'INSERT INTO kv VALUES (?, ?, ?, ?, ?) ON CONFLICT (namespace, key) DO UPDATE SET '
+            'value = excluded.value, expires = excluded.expires, touched = excluded.touched '
+            'WHERE kv.expires IS NOT NULL AND kv.expires < ?',
+            (namespace, key, json.dumps(value, default=str), now + ttl if ttl else None, now, now),
+        )
+        return cursor.rowcount == 1
+
+    def touch(self, namespace, key):
+        self._connect().execute('UPDATE kv SET touched = ? WHERE namespace = ? AND key = ?', (time.time(), namespace, key))
+
+    def delete(self, namespace, key):
+        self._connect().execute('DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def items(self, namespace):
+        rows = self._connect().execute(
+            'SELECT key, value FROM kv WHERE namespace = ? AND (expires IS NULL OR expires >= ?) ORDER BY touched',
+            (namespace, time.time()),
+        ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def claim(self, name, ttl):
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO kv VALUES ('claims', ?, ?, ?, ?) ON CONFLICT (namespace, key) DO UPDATE SET "
+            'value = excluded.value, expires = excluded.expires, touched = excluded.touched '
+            'WHERE kv.expires < ? OR kv.value = excluded.value',
+            (name, json.dumps(WORKER_ID), now + ttl, now, now),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, name):
+        self._connect().execute(
+            "DELETE FROM kv WHERE namespace = 'claims' AND key = ? AND value = ?", (name, json.dumps(WORKER_ID))
+        )
+
+    def purge(self):
+        self._connect().execute('DELETE FROM kv WHERE expires IS NOT NULL AND expires < ?', (time.time(),))
+
+    @contextmanager
+    def lock(self, name, timeout=30):
+        # Threads of this process queue on a local lock, processes on a claim row
+        with self._guard:
+            thread_lock = self._thread_locks.setdefault(name, threading.Lock())
+        if not thread_lock.acquire(timeout=timeout):
+            raise TimeoutError(f'Could not lock {name}')
+        try:
+            deadline = time.monotonic() + timeout
+            while not self.claim(f'lock:{name}', ttl=timeout):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Could not lock {name}')
+                time.sleep(0.01)
+            try:
+                yield
+            finally:
+                self.release(f'lock:{name}')
+        finally:
+            thread_lock.release()
+
+
+def create_shared_state():
+    if SHARED_STATE == 'memory':
+        return MemoryState()
+    if SHARED_STATE == 'sqlite':
+        return SqliteState(SHARED_STATE_DB)
+    raise ValueError(f'Unknown SHARED_STATE backend: {SHARED_STATE}')
+
+
+shared = create_shared_state()
+
+
 def authenticate():
     if DISABLE_EMAIL:
         return None
+    if GMAIL_API_URL:
+        if os.path.exists(TOKEN_FILE):
+            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+        else:
+            creds = AnonymousCredentials()
+        return build('gmail', 'v1', credentials=creds, client_options={'api_endpoint': GMAIL_API_URL})
     if os.path.exists(TOKEN_FILE):
         creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
         return build('gmail', 'v1', credentials=creds)
     return None
 
 
-def send_email(recipients, subject, body, attachments=None):
+def deliver_email(recipients, subject, body, attachments=None):
+    with span('email.send', recipients=len(recipients), attachments=len(attachments or []), client='sync') as attrs:
+        return _deliver_email(recipients, subject, body, attachments, attrs)
+
+
+def _deliver_email(recipients, subject, body, attachments, attrs):
     service = authenticate()
     if service is None:
         # Local test mode: skip sending
         print('[LOCAL TEST] Email disabled or token missing. Skipping send.')
+        attrs['skipped'] = 'disabled' if DISABLE_EMAIL else 'no_token'
         return
+    encoded_message = build_email_message(recipients, subject, body, attachments)
+    attrs['bytes'] = len(encoded_message)
+    service.users().messages().send(userId='me', body={'raw': encoded_message}).execute()
+
+
+def build_email_message(recipients, subject, body, attachments=None):
+    """MIME message with attachments, base64url-encoded for the Gmail API"""
     message = MIMEMultipart()
     message['To'] = ', '.join(recipients)
     message['Subject'] = subject
@@ -104,8 +625,121 @@ def send_email(recipients, subject, body, attachments=None):
             part.add_header('Content-Disposition', f'attachment; filename={filename}')
             message.attach(part)
 
-    encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-    service.users().messages().send(userId='me', body={'raw': encoded_message}).execute()
+    return base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+
+
+# ---------------- Email digests ----------------
+# With EMAIL_DIGEST=1 messages to the same recipients are buffered and sent as one
+# email once the window elapses or the attachment limits are reached. Callers were
+# already told 'queued', so a failed send is retried with backoff and recorded in the ledger.
+_digests = {}  # frozenset(recipients) -> pending digest
+_digest_retries = {}  # id(digest) -> (timer, digest, attempt) waiting to be resent
+_digests_lock = threading.Lock()
+
+
+def send_email(recipients, subject, body, attachments=None, kind=None, urgent=False):
+    """Send now, or queue into the recipients' digest when coalescing is enabled"""
+    if not EMAIL_DIGEST or urgent or kind in EMAIL_URGENT_TYPES:
+        return deliver_email(recipients, subject, body, attachments)
+    attachments = [p for p in attachments or [] if os.path.exists(p)]
+    size = sum(os.path.getsize(p) for p in attachments)
+    if len(attachments) > EMAIL_DIGEST_MAX_ATTACHMENTS or size > EMAIL_DIGEST_MAX_BYTES:
+        # Too big to share an email with anything else
+        return deliver_email(recipients, subject, body, attachments)
+
+    with span('email.queue', recipients=len(recipients), attachments=len(attachments)) as attrs:
+        key = frozenset(recipients)
+        full = None
+        with _digests_lock:
+            digest = _digests.get(key)
+            if digest is not None and (
+                len(digest['attachments']) + len(attachments) > EMAIL_DIGEST_MAX_ATTACHMENTS
+                or digest['size'] + size > EMAIL_DIGEST_MAX_BYTES
+            ):
+                full = _digests.pop(key)
+                full['timer'].cancel()
+                digest = None
+            if digest is None:
+                digest = {'recipients': list(recipients), 'messages': [], 'attachments': [], 'size': 0}
+                digest['timer'] = threading.Timer(EMAIL_DIGEST_WINDOW, flush_digest, args=(key, digest))
+                digest['timer'].daemon = True
+                digest['timer'].start()
+                _digests[key] = digest
+            digest['messages'].append((subject, body))
+            digest['attachments'].extend(p for p in attachments if p not in digest['attachments'])
+            digest['size'] += size
+            queued = len(digest['messages'])
+            attrs['position'] = queued
+        if full is not None:
+            _deliver_digest(full)
+    return {'digest': 'queued', 'position': queued}
+
+
+def flush_digest(key, digest=None):
+    """Send a pending digest now; digest guards against flushing a newer one by mistake"""
+    with _digests_lock:
+        current = _digests.get(key)
+        if current is None or (digest is not None and current is not digest):
+            return
+        del _digests[key]
+        current['timer'].cancel()
+    _deliver_digest(current)
+
+
+def flush_all_digests():
+    """Send every pending digest and due retry now; used at shutdown, so no further retries"""
+    with _digests_lock:
+        keys = list(_digests)
+        retries = list(_digest_retries.values())
+        _digest_retries.clear()
+    for key in keys:
+        flush_digest(key)
+    for timer, digest, attempt in retries:
+        timer.cancel()
+        _deliver_digest(digest, attempt, retry=False)
+
+
+def _retry_digest(digest, attempt):
+    with _digests_lock:
+        if _digest_retries.pop(id(digest), None) is None:
+            return  # already taken by flush_all_digests
+    _deliver_digest(digest, attempt)
+
+
+def _deliver_digest(digest, attempt=1, retry=True):
+    messages = digest['messages']
+    if len(messages) == 1:
+        subject, body = messages[0]
+    else:
+        subject = f"DIGEST: {len(messages)} messages - {messages[0][0]}"
+        sections = '\n\n'.join(f"=== {s} ===\n\n{b}" for s, b in messages)
+        body = f"This email combines {len(messages)} messages:\n\n{sections}"
+    entry = {
+        'recipients': digest['recipients'],
+        'subjects': [s for s, _ in messages],
+        'files': [os.path.basename(p) for p in digest['attachments']],
+        'attempt': attempt,
+    }
+    try:
+        deliver_email(digest['recipients'], subject, body, digest['attachments'])
+    except Exception as e:
+        final = not retry or attempt > EMAIL_DIGEST_RETRIES
+        print(f"[DIGEST] Send failed for {', '.join(digest['recipients'])} (attempt {attempt}"
+              f"{', giving up' if final else ''}): {e}")
+        try:
+            write_ledger({'kind': 'digest_failed', **entry, 'error': str(e), 'final': final})
+        except OSError as le:
+            print(f"[DIGEST] Could not record failed digest: {le}")
+        if not final:
+            timer = threading.Timer(EMAIL_DIGEST_RETRY_DELAY * 2 ** (attempt - 1), _retry_digest, args=(digest, attempt + 1))
+            timer.daemon = True
+            with _digests_lock:
+                _digest_retries[id(digest)] = (timer, digest, attempt + 1)
+            timer.start()
+        return False
+    if attempt > 1:
+        write_ledger({'kind': 'digest_sent', **entry})
+    return True
 
 
 def replace_and_format_run(run, old_string, new_string):
@@ -117,20 +751,24 @@ def replace_and_format_run(run, old_string, new_string):
 
 
 def replace_strings_in_docx(doc_path, output_path, replacements, save):
-    doc = Document(doc_path)
-    for paragraph in doc.paragraphs:
-        for run in paragraph.runs:
-            for old_string, new_string in replacements.items():
-                replace_and_format_run(run, old_string, new_string)
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    for run in paragraph.runs:
-                        for old_string, new_string in replacements.items():
-                            replace_and_format_run(run, old_string, new_string)
+    with span('docx.load', template=os.path.basename(doc_path), bytes=os.path.getsize(doc_path)):
+        doc = Document(doc_path)
+    with span('docx.replace', fields=len(replacements)):
+        for paragraph in doc.paragraphs:
+            for run in paragraph.runs:
+                for old_string, new_string in replacements.items():
+                    replace_and_format_run(run, old_string, new_string)
+        for table in doc.tables:
+            for row in table.rows:
+                for cell in row.cells:
+                    for paragraph in cell.paragraphs:
+                        for run in paragraph.runs:
+                            for old_string, new_string in replacements.items():
+                                replace_and_format_run(run, old_string, new_string)
     if save == 1:
-        doc.save(output_path)
+        with span('docx.save', file=os.path.basename(output_path)) as attrs:
+            doc.save(output_path)
+            attrs['bytes'] = os.path.getsize(output_path)
 
 
 def get_bunker_date(value):
@@ -140,7 +778,60 @@ def get_bunker_date(value):
     return date(int(value[2]), int(value[1]), int(value[0]))
 
 
-def convert_docx_to_pdf(input_path, output_path, librepath):
+def _pdf_filter_options(options):
+    # LibreOffice >= 7.4 takes writer_pdf_Export options as typed JSON
+    typed = {}
+    for name, value in options.items():
+        if isinstance(value, bool):
+            typed[name] = {'type': 'boolean', 'value': 'true' if value else 'false'}
+        elif isinstance(value, int):
+            typed[name] = {'type': 'long', 'value': str(value)}
+        else:
+            typed[name] = {'type': 'string', 'value': str(value)}
+    return json.dumps(typed, separators=(',', ':'))
+
+
+def optimize_pdf(path):
+    """Rewrite a PDF without unreferenced objects, with compressed object streams.
+
+    Returns (size_before, size_after); the file is left untouched if pikepdf
+    is missing or the rewrite would not make it smaller.
+    """
+    tmp_path = path + '.tmp'
+    before = 0
+    try:
+        before = os.path.getsize(path)
+        if pikepdf is None:
+            return before, before
+        with span('pdf.optimize', bytes_before=before) as attrs, pikepdf.open(path) as pdf:
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                tmp_path,
+                compress_streams=True,
+                recompress_flate=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            )
+        after = os.path.getsize(tmp_path)
+        attrs['bytes_after'] = after
+        if after < before:
+            os.replace(tmp_path, path)
+            return before, after
+        return before, before
+    except Exception as e:
+        print(f"[PDF] Optimisation skipped for {os.path.basename(path)} ({type(e).__name__})")
+        return before, before
+    finally:
+        delete_file(tmp_path)
+
+
+def convert_docx_to_pdf(input_path, output_path, librepath, profile=None):
+    with span('convert', file=os.path.basename(input_path), profile=profile or PDF_PROFILE) as attrs:
+        final_path = _convert_docx_to_pdf(input_path, output_path, librepath, profile, attrs)
+        attrs['bytes'] = os.path.getsize(final_path) if os.path.exists(final_path) else None
+        return final_path
+
+
+def _convert_docx_to_pdf(input_path, output_path, librepath, profile, attrs):
     if not input_path.endswith('.docx'):
         raise ValueError('Input file must be a .docx file.')
     if not output_path.endswith('.pdf'):
@@ -154,27 +845,50 @@ def convert_docx_to_pdf(input_path, output_path, librepath):
     if not os.path.exists(librepath):
         # Fallback: skip conversion in local test
         print('[LOCAL TEST] LibreOffice not found. Returning DOCX instead of PDF.')
+        attrs['fallback'] = 'libreoffice_missing'
         return input_path
+    profile = profile or PDF_PROFILE
+    if profile not in PDF_PROFILES:
+        raise ValueError(f'Unknown PDF profile: {profile}')
+    export_options = PDF_PROFILES[profile]
+    convert_to = f'pdf:writer_pdf_Export:{_pdf_filter_options(export_options)}' if export_options else 'pdf'
+
+    # One LibreOffice profile per thread: renders run concurrently in the thread pool, and a
+    # second soffice on a busy profile hands the job over and can exit 0 without a PDF.
+    # Pool threads are reused, so each profile is still only initialised once.
+    profile_dir = os.path.join(tempfile.gettempdir(), f'lo_profile_{os.getpid()}_{threading.get_ident()}')
     command = [
         librepath,
+        f'-env:UserInstallation=file:///{profile_dir.replace(os.sep, "/").lstrip("/")}',
         '--headless',
-        '--convert-to', 'pdf',
+        '--convert-to', convert_to,
         '--outdir', output_dir,
         input_path,
     ]
     try:
-        subprocess.run(
-            command,
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            timeout=25,  # fail fast if LibreOffice hangs
-        )
-        return output_path
+        with span('convert.soffice'):
+            subprocess.run(
+                command,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=25,  # fail fast if LibreOffice hangs
+            )
     except Exception as e:
         # On any error or timeout, fall back to returning the original DOCX path
         print(f"[LOCAL TEST] Conversion skipped ({type(e).__name__}). Returning DOCX path.")
+        attrs['fallback'] = type(e).__name__
         return input_path
+    if not os.path.exists(output_path):
+        # soffice can exit 0 without writing anything
+        print(f"[LOCAL TEST] Conversion produced no PDF for {os.path.basename(input_path)}. Returning DOCX path.")
+        attrs['fallback'] = 'pdf_missing'
+        return input_path
+    # PDF/A output must not be rewritten, it would lose conformance
+    if PDF_POSTPROCESS and profile != 'archive':
+        before, after = optimize_pdf(output_path)
+        print(f"[PDF] {os.path.basename(output_path)} ({profile}): {before / 1024:.1f} KB -> {after / 1024:.1f} KB")
+    return output_path
 
 
 def delete_file(file_path):
@@ -188,24 +902,891 @@ def upload_files_to_s3(file_paths):
         return []
     uploaded_urls = []
     for file_path in file_paths:
+        filename = os.path.basename(file_path)
+        key = f"{S3_PREFIX}{filename}"
+        with span('s3.upload', key=key, bytes=os.path.getsize(file_path) if os.path.exists(file_path) else None, client='sync') as attrs:
+            try:
+                client.upload_file(file_path, S3_BUCKET, key)
+                # Generate a presigned URL valid for 7 days
+                url = client.generate_presigned_url(
+                    'get_object',
+                    Params={'Bucket': S3_BUCKET, 'Key': key},
+                    ExpiresIn=7 * 24 * 3600,
+                )
+                uploaded_urls.append({'key': key, 'url': url})
+            except (BotoCoreError, ClientError) as e:
+                print(f"[S3] Upload failed for {file_path}: {e}")
+                attrs['failed'] = str(e)
+    return uploaded_urls
+
+
+_ledger_lock = threading.Lock()
+def write_ledger(entry):
+    """Append one record to the JSONL ledger of generated documents"""
+    record = {'ts': datetime.now().isoformat(timespec='seconds'), **entry}
+    line = json.dumps(record, default=str)
+    with _ledger_lock:
+        with open(LEDGER_FILE, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    return record
+
+
+_stage_pool = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='stage')
+
+def _timed_call(name, fn):
+    """Run one stage; returns (value, error, elapsed) so a failure keeps its own timing"""
+    started = time.monotonic()
+    try:
+        with span(f'stage.{name}'):
+            value = profiled(fn)()
+    except Exception as e:
+        return None, e, time.monotonic() - started
+    return value, None, time.monotonic() - started
+
+
+def run_stages(stages):
+    """Run independent stages concurrently.
+
+    `stages` maps a stage name to (callable, timeout). Every stage is reported
+    separately as {'ok', 'result', 'error', 'elapsed'}; a failing or slow stage
+    never cancels the others.
+    """
+    started = time.monotonic()
+    # Each stage runs in a copy of the caller's context so its spans join the request's trace
+    futures = {
+        name: (_stage_pool.submit(contextvars.copy_context().run, _timed_call, name, fn), timeout)
+        for name, (fn, timeout) in stages.items()
+    }
+    results = {}
+    for name, (future, timeout) in futures.items():
+        remaining = max(0.0, started + timeout - time.monotonic())
         try:
-            filename = os.path.basename(file_path)
-            key = f"{S3_PREFIX}{filename}"
-            client.upload_file(file_path, S3_BUCKET, key)
-            # Generate a presigned URL valid for 7 days
+            value, error, elapsed = future.result(timeout=remaining)
+            if error is None:
+                results[name] = {'ok': True, 'result': value, 'error': None, 'elapsed': round(elapsed, 3)}
+            else:
+                print(f"[STAGE] {name} failed: {type(error).__name__}: {error}")
+                results[name] = {'ok': False, 'result': None, 'error': str(error), 'elapsed': round(elapsed, 3)}
+        except FutureTimeout:
+            # The worker thread keeps running; we just stop waiting for it
+            print(f"[STAGE] {name} timed out after {timeout}s")
+            results[name] = {'ok': False, 'result': None, 'error': f'Timed out after {timeout}s', 'elapsed': timeout}
+        except Exception as e:
+            print(f"[STAGE] {name} failed: {type(e).__name__}: {e}")
+            results[name] = {'ok': False, 'result': None, 'error': str(e), 'elapsed': round(time.monotonic() - started, 3)}
+    return results
+
+
+async def run_stages_async(stages):
+    """run_stages for the event loop.
+
+    A stage is (coroutine, timeout) or (callable, timeout); callables run in the
+    stage pool as before. Results have the same shape as run_stages. A coroutine
+    that times out is cancelled, a thread is only abandoned.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def run(name, job, timeout):
+        began = time.monotonic()
+        try:
+            with span(f'stage.{name}'):
+                if asyncio.iscoroutine(job):
+                    value = await asyncio.wait_for(job, timeout)
+                else:
+                    future = loop.run_in_executor(_stage_pool, contextvars.copy_context().run, profiled(job))
+                    value = await asyncio.wait_for(future, timeout)
+            return {'ok': True, 'result': value, 'error': None, 'elapsed': round(time.monotonic() - began, 3)}
+        except asyncio.TimeoutError:
+            print(f"[STAGE] {name} timed out after {timeout}s")
+            return {'ok': False, 'result': None, 'error': f'Timed out after {timeout}s', 'elapsed': timeout}
+        except Exception as e:
+            print(f"[STAGE] {name} failed: {type(e).__name__}: {e}")
+            return {'ok': False, 'result': None, 'error': str(e), 'elapsed': round(time.monotonic() - began, 3)}
+
+    names = list(stages)
+    results = await asyncio.gather(*(run(name, *stages[name]) for name in names))
+    return dict(zip(names, results))
+
+
+# ---------------- Async Gmail / S3 ----------------
+# One keep-alive connection pool serves every send and upload, so hundreds can be
+# in flight without a thread each. With ASYNC_IO=0 the *_async functions hand the
+# sync clients to a thread, which is how it worked before.
+_async_http = None  # (event loop, [httpx.AsyncClient, ...])
+_async_http_next = 0
+_gmail_creds = None
+_gmail_creds_lock = threading.Lock()
+_s3_credentials = None
+
+
+def async_http():
+    """A pooled client of the running event loop, round-robin over the pools"""
+    global _async_http, _async_http_next
+    loop = asyncio.get_running_loop()
+    if _async_http is None or _async_http[0] is not loop:
+        pools = max(1, -(-ASYNC_MAX_CONNECTIONS // ASYNC_POOL_SIZE))
+        limits = httpx.Limits(
+            max_connections=-(-ASYNC_MAX_CONNECTIONS // pools),
+            max_keepalive_connections=-(-ASYNC_KEEPALIVE // pools),
+        )
+        timeout = httpx.Timeout(60.0, connect=10.0)
+        _async_http = (loop, [httpx.AsyncClient(limits=limits, timeout=timeout) for _ in range(pools)])
+    clients = _async_http[1]
+    _async_http_next = (_async_http_next + 1) % len(clients)
+    return clients[_async_http_next]
+
+
+async def close_async_http():
+    global _async_http
+    if _async_http is not None:
+        clients, _async_http = _async_http[1], None
+        await asyncio.gather(*(client.aclose() for client in clients))
+
+
+def gmail_auth_headers(blocking=True):
+    """Authorization header for Gmail REST calls, None when sending is off.
+
+    Loading or refreshing the token blocks; with blocking=False that case
+    returns False instead, so the caller can do it in a thread.
+    """
+    global _gmail_creds
+    if DISABLE_EMAIL:
+        return None
+    if not os.path.exists(TOKEN_FILE):
+        # The local stub takes anonymous calls, the real API does not
+        return {} if GMAIL_API_URL else None
+    creds = _gmail_creds
+    if creds is not None and creds.valid:
+        return {'Authorization': f'Bearer {creds.token}'}
+    if not blocking:
+        return False
+    with _gmail_creds_lock:
+        if _gmail_creds is None:
+            _gmail_creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+        if not _gmail_creds.valid:
+            _gmail_creds.refresh(GoogleAuthRequest())
+        return {'Authorization': f'Bearer {_gmail_creds.token}'}
+
+
+async def deliver_email_async(recipients, subject, body, attachments=None):
+    with span('email.send', recipients=len(recipients), attachments=len(attachments or []), client='async') as attrs:
+        headers = gmail_auth_headers(blocking=False)
+        if headers is False:
+            headers = await run_in_threadpool(gmail_auth_headers)
+        if headers is None:
+            print('[LOCAL TEST] Email disabled or token missing. Skipping send.')
+            attrs['skipped'] = 'disabled' if DISABLE_EMAIL else 'no_token'
+            return
+        if attachments:
+            # Reading and base64-encoding attachments blocks; keep it off the event loop
+            encoded_message = await run_in_threadpool(build_email_message, recipients, subject, body, attachments)
+        else:
+            encoded_message = build_email_message(recipients, subject, body, attachments)
+        attrs['bytes'] = len(encoded_message)
+        base = (GMAIL_API_URL or 'https://gmail.googleapis.com/').rstrip('/')
+        response = await async_http().post(
+            f'{base}/gmail/v1/users/me/messages/send',
+            json={'raw': encoded_message},
+            headers=headers,
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+async def send_email_async(recipients, subject, body, attachments=None, kind=None, urgent=False):
+    """send_email without holding a thread for the Gmail round-trip"""
+    if not ASYNC_IO or (EMAIL_DIGEST and not urgent and kind not in EMAIL_URGENT_TYPES):
+        # Digests are queued in memory and flushed by a timer thread either way
+        return await run_in_threadpool(send_email, recipients, subject, body, attachments, kind, urgent)
+    return await deliver_email_async(recipients, subject, body, attachments)
+
+
+def s3_object_url(client, key):
+    key = quote(key, safe='/~')
+    if S3_ENDPOINT_URL:
+        # Path-style, like get_s3_client
+        return f"{S3_ENDPOINT_URL.rstrip('/')}/{S3_BUCKET}/{key}"
+    return f'https://{S3_BUCKET}.s3.{client.meta.region_name}.amazonaws.com/{key}'
+
+
+def prepare_s3_async():
+    """Build the boto3 client and resolve credentials, both blocking; done at startup"""
+    global _s3_credentials
+    client = get_s3_client()
+    if client is not None and _s3_credentials is None:
+        _s3_credentials = boto3.Session().get_credentials()
+    return client
+
+
+def _signed_s3_put(client, key, file_path):
+    """Read a file and sign its PUT exactly as boto3 would; returns (url, data, headers)"""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    url = s3_object_url(client, key)
+    request = AWSRequest(method='PUT', url=url, data=data, headers={
+        'Content-Type': mimetypes.guess_type(key)[0] or 'application/octet-stream',
+    })
+    S3SigV4Auth(_s3_credentials.get_frozen_credentials(), 's3', client.meta.region_name).add_auth(request)
+    return url, data, dict(request.headers.items())
+
+
+async def _upload_file_async(client, file_path):
+    filename = os.path.basename(file_path)
+    key = f"{S3_PREFIX}{filename}"
+    with span('s3.upload', key=key, bytes=os.path.getsize(file_path) if os.path.exists(file_path) else None, client='async') as attrs:
+        try:
+            if _s3_credentials is None:
+                raise NoCredentialsError()
+            # File read and payload hashing block; only the PUT itself runs on the event loop
+            url, data, headers = await run_in_threadpool(_signed_s3_put, client, key, file_path)
+            response = await async_http().put(url, content=data, headers=headers)
+            response.raise_for_status()
+            # Presigning is local, no request involved
             url = client.generate_presigned_url(
                 'get_object',
                 Params={'Bucket': S3_BUCKET, 'Key': key},
                 ExpiresIn=7 * 24 * 3600,
             )
-            uploaded_urls.append({'key': key, 'url': url})
-        except (BotoCoreError, ClientError) as e:
+            return {'key': key, 'url': url}
+        except (OSError, httpx.HTTPError, BotoCoreError) as e:
             print(f"[S3] Upload failed for {file_path}: {e}")
-    return uploaded_urls
+            attrs['failed'] = str(e)
+            return None
 
 
-def process_both(vessel_name, vessel_imo, supply_dates, mgo_tons, mgo_price, ifo_tons, ifo_price, agent):
-    global queued_up_files
+async def upload_files_to_s3_async(file_paths):
+    """upload_files_to_s3 with every file in flight at once"""
+    if not ASYNC_IO:
+        return await run_in_threadpool(upload_files_to_s3, file_paths)
+    client = _s3_client if _s3_credentials is not None else await run_in_threadpool(prepare_s3_async)
+    if client is None:
+        return []
+    uploaded = await asyncio.gather(*(_upload_file_async(client, p) for p in file_paths))
+    return [u for u in uploaded if u]
+
+
+def render_docx(in_path, out_path, replacements, replacements2, draft=None, keep_base=False):
+    """Apply both replacement passes to a template, or a single pass over a matching draft.
+
+    Returns 'hit' when the draft matched what the initial request announced,
+    'patched' when quantities/dates changed since, and None for a full render.
+    With keep_base the document with only the baked fields applied is kept as
+    the base that /final-nomination patches later.
+    """
+    with span('render', template=os.path.basename(in_path)) as attrs:
+        status = _render_docx(in_path, out_path, replacements, replacements2, draft, keep_base, attrs)
+        attrs['draft'] = status
+        return status
+
+
+def _render_docx(in_path, out_path, replacements, replacements2, draft, keep_base, attrs):
+    started = time.monotonic()
+    merged = {**replacements, **replacements2}
+    status = None
+    base_path = None
+    if draft is not None and draft['template'] == in_path and os.path.exists(in_path) \
+            and draft['template_mtime'] == os.path.getmtime(in_path):
+        if all(str(merged.get(k)) == v for k, v in draft['baked'].items()):
+            remaining = {k: v for k, v in merged.items() if k not in draft['baked']}
+            try:
+                with span('render.pass', step='draft'):
+                    replace_strings_in_docx(draft['path'], out_path, remaining, 1)
+                changed = [k for k, v in draft['expected'].items() if str(merged.get(k)) != v]
+                status = 'patched' if changed else 'hit'
+                base_path = draft['path']
+            except Exception as e:
+                # Draft evicted or unreadable: fall through to a full render
+                print(f"[DRAFT] Draft unusable ({type(e).__name__}), rendering from template")
+                attrs['fallback'] = f'draft_unusable: {type(e).__name__}'
+        else:
+            attrs['fallback'] = 'draft_mismatch'
+    if status is None:
+        if keep_base:
+            # Same two passes, split baked/remaining instead of replacements/replacements2
+            os.makedirs(DRAFTS_DIR, exist_ok=True)
+            base_path = os.path.join(DRAFTS_DIR, f'base-{uuid.uuid4().hex}.docx')
+            baked = {k: merged[k] for k in DRAFT_BAKED_FIELDS if k in merged}
+            with span('render.pass', step='baked'):
+                replace_strings_in_docx(in_path, base_path, baked, 1)
+            with span('render.pass', step='remaining'):
+                replace_strings_in_docx(base_path, out_path, {k: v for k, v in merged.items() if k not in baked}, 1)
+        else:
+            with span('render.pass', step='replacements'):
+                replace_strings_in_docx(in_path, out_path, replacements, 1)
+            with span('render.pass', step='replacements2'):
+                replace_strings_in_docx(out_path, out_path, replacements2, 1)
+    if keep_base:
+        register_base(in_path, base_path, merged, time.monotonic() - started)
+    return status
+
+
+# ---------------- Nomination drafts ----------------
+# /initial-request pre-renders the fields that rarely change (company, vessel, agent)
+# into a draft; /endpoint1 fills in the rest from that draft instead of the template.
+# Every nomination rendered by /endpoint1 or /fleet-nomination keeps such a base
+# too, which /final-nomination patches with the actual quantities, prices and dates.
+DRAFT_BAKED_FIELDS = ('X1_CN', 'X1_VSLN', 'X1_AGNT', 'X1_UC', 'X1_DDD')
+
+# Index in the shared 'drafts' namespace: 'kind|VESSEL NAME' -> draft and
+# 'rendered|reference' -> base, least recently used first
+_draft_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='draft')
+_draft_pending = 0
+_draft_pending_lock = threading.Lock()
+# Set inside a fleet render process: bases are handed back to the parent
+# instead of going into this process's own copy of the shared state
+_collected_bases = None
+
+
+def nomination_templates():
+    return {'mgo': MGO_TEMPLATE, 'ifo': IFO_TEMPLATE, 'both': BOTH_TEMPLATE}
+
+
+def _evict_drafts_locked():
+    """Drop expired and least recently used entries; returns the remaining ones"""
+    now = time.time()
+    live = []
+    for key, entry in shared.items('drafts'):
+        if now - entry['created'] > DRAFT_TTL:
+            shared.delete('drafts', key)
+            delete_file(entry['path'])
+        else:
+            live.append((key, entry))
+    excess = max(0, len(live) - DRAFT_MAX)
+    for key, entry in live[:excess]:
+        shared.delete('drafts', key)
+        delete_file(entry['path'])
+    return live[excess:]
+
+
+def create_draft(kind, baked, expected):
+    """Pre-render the baked fields of a nomination into DRAFTS_DIR"""
+    template = nomination_templates()[kind]
+    if not os.path.exists(template):
+        return None
+    os.makedirs(DRAFTS_DIR, exist_ok=True)
+    path = os.path.join(DRAFTS_DIR, f'{kind}-{uuid.uuid4().hex}.docx')
+    template_mtime = os.path.getmtime(template)
+    replace_strings_in_docx(template, path, baked, 1)
+    draft = {
+        'kind': kind,
+        'template': template,
+        'template_mtime': template_mtime,
+        'path': path,
+        'baked': {k: str(v) for k, v in baked.items()},
+        'expected': {k: str(v) for k, v in expected.items()},
+        'created': time.time(),
+    }
+    key = f"{kind}|{draft['baked']['X1_VSLN']}"
+    with shared.lock('drafts'):
+        old = shared.get('drafts', key)
+        if old:
+            delete_file(old['path'])
+        shared.put('drafts', key, draft)
+        _evict_drafts_locked()
+    return draft
+
+
+def register_base(template, path, values, render_time):
+    """Remember the base of a rendered nomination; a consumed draft becomes that base"""
+    if _collected_bases is not None:
+        _collected_bases.append((template, path, values, render_time))
+        return None
+    reference = str(values['X1_RN'])
+    entry = {
+        'kind': 'rendered',
+        'template': template,
+        'template_mtime': os.path.getmtime(template),
+        'path': path,
+        'baked': {k: str(values[k]) for k in DRAFT_BAKED_FIELDS if k in values},
+        'values': {k: str(v) for k, v in values.items()},
+        'expected': {k: str(values[k]) for k in ('X1_VSLSD', 'X1_MQ', 'X1_IQ') if k in values},
+        'render_ms': round(render_time * 1000, 1),
+        'created': time.time(),
+    }
+    key = f'rendered|{reference}'
+    with shared.lock('drafts'):
+        # The base file now belongs to this entry only
+        for other_key, other in shared.items('drafts'):
+            if other['path'] == path:
+                shared.delete('drafts', other_key)
+        old = shared.get('drafts', key)
+        if old and old['path'] != path:
+            delete_file(old['path'])
+        shared.put('drafts', key, entry)
+        _evict_drafts_locked()
+    return entry
+
+
+def _supply_range(supply_dates):
+    parts = str(supply_dates).split('-')
+    return get_bunker_date(parts[0]), get_bunker_date(parts[-1])
+
+
+def find_rendered(vessel_name, bunker_date):
+    """Latest rendered nomination for a vessel, preferring one whose supply dates cover bunker_date"""
+    vessel = str(vessel_name).upper()
+    with shared.lock('drafts'):
+        live = _evict_drafts_locked()
+    candidates = [(k, d) for k, d in live if d['kind'] == 'rendered' and d['baked'].get('X1_VSLN') == vessel]
+    if not candidates:
+        return None
+    covering = []
+    for key, entry in candidates:
+        try:
+            start, end = _supply_range(entry['values'].get('X1_VSLSD', ''))
+        except (ValueError, IndexError):
+            continue
+        if start <= bunker_date <= end:
+            covering.append((key, entry))
+    key, entry = max(covering or candidates, key=lambda item: item[1]['created'])
+    shared.touch('drafts', key)
+    return entry
+
+
+def find_draft(kind, vessel_name):
+    """Draft from /initial-request, else the base of the vessel's latest rendered nomination"""
+    vessel = str(vessel_name).upper()
+    template = nomination_templates()[kind]
+    with shared.lock('drafts'):
+        live = dict(_evict_drafts_locked())
+    key = f'{kind}|{vessel}'
+    draft = live.get(key)
+    if draft is None:
+        rendered = [
+            (k, d) for k, d in live.items()
+            if d['kind'] == 'rendered' and d['template'] == template and d['baked'].get('X1_VSLN') == vessel
+        ]
+        if not rendered:
+            return None
+        key, draft = max(rendered, key=lambda item: item[1]['created'])
+    shared.touch('drafts', key)
+    return draft
+
+
+def _iso_to_supply_date(value):
+    # Dashboard date inputs send YYYY-MM-DD; nominations use DD.MM.YYYY
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%d.%m.%Y')
+    except ValueError:
+        return value
+
+
+def schedule_draft(request_data):
+    """Queue a low-priority pre-render for an initial request. Returns False if skipped"""
+    global _draft_pending
+    mgo_tons = str(request_data.mgo_tons or '0').strip() or '0'
+    ifo_tons = str(request_data.ifo_tons or '0').strip() or '0'
+    kind = nomination_kind(mgo_tons, ifo_tons)
+    if kind is None or not request_data.vessel_name:
+        return False
+    start = _iso_to_supply_date(request_data.bunker_date_start)
+    end = _iso_to_supply_date(request_data.bunker_date_end)
+    supply_dates = f'{start}-{end}' if end and end != start else start
+    baked = {
+        'X1_CN': str('Simple Fuel FZCO').upper(),
+        'X1_VSLN': str(request_data.vessel_name).upper(),
+        'X1_AGNT': request_data.agent_name,
+        'X1_UC': 'USD',
+        'X1_DDD': 30,
+    }
+    expected = {'X1_VSLSD': supply_dates}
+    if kind in ('mgo', 'both'):
+        expected['X1_MQ'] = mgo_tons
+    if kind in ('ifo', 'both'):
+        expected['X1_IQ'] = ifo_tons
+
+    # Another worker may already be pre-rendering the same request
+    job = f"draft:{kind}|{baked['X1_VSLN']}"
+    if not shared.claim(job, ttl=300):
+        return False
+    with _draft_pending_lock:
+        if _draft_pending >= DRAFT_QUEUE_MAX:
+            shared.release(job)
+            return False
+        _draft_pending += 1
+
+    def run():
+        global _draft_pending
+        try:
+            create_draft(kind, baked, expected)
+        except Exception as e:
+            print(f"[DRAFT] Pre-render failed for {request_data.vessel_name}: {e}")
+        finally:
+            shared.release(job)
+            with _draft_pending_lock:
+                _draft_pending -= 1
+
+    _draft_pool.submit(run)
+    return True
+
+
+# ---------------- finished_noms storage ----------------
+def doc_type(filename):
+    """Shard directory for a generated document"""
+    if '-B-' in filename or '-INV-' in filename:
+        return 'invoices'
+    if '-STMT-' in filename:
+        return 'statements'
+    if '-NOM-' in filename:
+        return 'nominations'
+    return 'other'
+
+
+def shard_dir(filename):
+    # Names start with the supply date (YYYYMMDD-...)
+    stamp = filename[:8]
+    if len(stamp) == 8 and stamp.isdigit():
+        year, month = stamp[:4], stamp[4:6]
+    else:
+        year, month = 'undated', ''
+    return os.path.join(FINISHED_DIR, doc_type(filename), year, month)
+
+
+def finished_path(filename):
+    """Where a generated file is written"""
+    if not STORAGE_SHARDED:
+        return os.path.join(FINISHED_DIR, filename)
+    directory = shard_dir(filename)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def find_finished(filename):
+    """Local path of a generated file in the sharded or the old flat layout, or None"""
+    filename = os.path.basename(filename)
+    for path in (os.path.join(shard_dir(filename), filename), os.path.join(FINISHED_DIR, filename)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def iter_finished():
+    for root, _, names in os.walk(FINISHED_DIR):
+        for name in names:
+            yield os.path.join(root, name)
+
+
+def migrate_finished():
+    """Move files from the flat finished_noms layout into shards"""
+    moved = []
+    for name in os.listdir(FINISHED_DIR):
+        path = os.path.join(FINISHED_DIR, name)
+        if not os.path.isfile(path):
+            continue
+        directory = shard_dir(name)
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, name)
+        if os.path.exists(target):
+            continue
+        os.replace(path, target)
+        moved.append(name)
+    return moved
+
+
+def in_s3(filename):
+    client = get_s3_client()
+    if client is None:
+        return False
+    try:
+        client.head_object(Bucket=S3_BUCKET, Key=f"{S3_PREFIX}{filename}")
+        return True
+    except (BotoCoreError, ClientError):
+        return False
+
+
+def fetch_from_s3(filename):
+    """Download a generated file from S3 into its local shard; returns the path or None"""
+    client = get_s3_client()
+    if client is None:
+        return None
+    filename = os.path.basename(filename)
+    path = finished_path(filename)
+    tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+    try:
+        with span('s3.download', key=f"{S3_PREFIX}{filename}") as attrs:
+            client.download_file(S3_BUCKET, f"{S3_PREFIX}{filename}", tmp_path)
+            os.replace(tmp_path, path)
+            attrs['bytes'] = os.path.getsize(path)
+        return path
+    except (BotoCoreError, ClientError) as e:
+        print(f"[S3] Download failed for {filename}: {e}")
+        delete_file(tmp_path)
+        return None
+
+
+def run_janitor():
+    """One cleanup pass over finished_noms and stale drafts. Returns what was removed"""
+    removed = {'leftover': [], 'age': [], 'size': [], 'drafts': []}
+    now = time.time()
+    files = []
+    for path in iter_finished():
+        name = os.path.basename(path)
+        # DOCX next to its PDF (delete after conversion failed), or an interrupted PDF rewrite
+        if name.endswith('.tmp') or (name.endswith('.docx') and os.path.exists(path[:-5] + '.pdf')):
+            if now - os.path.getmtime(path) > 3600:
+                delete_file(path)
+                removed['leftover'].append(name)
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    def deletable(path):
+        return not RETENTION_REQUIRE_S3 or in_s3(os.path.basename(path))
+
+    files.sort()
+    kept = []
+    for mtime, size, path in files:
+        if RETENTION_DAYS and now - mtime > RETENTION_DAYS * 86400 and deletable(path):
+            delete_file(path)
+            removed['age'].append(os.path.basename(path))
+        else:
+            kept.append((mtime, size, path))
+    if RETENTION_MAX_MB:
+        total = sum(size for _, size, _ in kept)
+        limit = RETENTION_MAX_MB * 1024 * 1024
+        for mtime, size, path in kept:
+            if total <= limit:
+                break
+            if deletable(path):
+                delete_file(path)
+                removed['size'].append(os.path.basename(path))
+                total -= size
+
+    # Shards emptied by the limits above
+    for root, _, _ in os.walk(FINISHED_DIR, topdown=False):
+        if root != FINISHED_DIR and not os.listdir(root):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+    # Drafts and bases outlive their in-memory index after a restart
+    if os.path.isdir(DRAFTS_DIR):
+        live = {d['path'] for _, d in shared.items('drafts')}
+        for name in os.listdir(DRAFTS_DIR):
+            path = os.path.join(DRAFTS_DIR, name)
+            if path not in live and now - os.path.getmtime(path) > DRAFT_TTL:
+                delete_file(path)
+                removed['drafts'].append(name)
+    if any(removed.values()):
+        print(f"[JANITOR] Removed {', '.join(f'{len(v)} {k}' for k, v in removed.items() if v)}")
+    return removed
+
+
+_janitor_stop = threading.Event()
+def _janitor_loop():
+    while not _janitor_stop.wait(JANITOR_INTERVAL):
+        # Only one worker per interval does the pass
+        if not shared.claim('janitor', ttl=JANITOR_INTERVAL * 0.9):
+            continue
+        try:
+            shared.purge()
+            run_janitor()
+        except Exception as e:
+            print(f"[JANITOR] Pass failed: {type(e).__name__}: {e}")
+
+
+# ---------------- Vessel registry ----------------
+VESSEL_CSV_COLUMNS = {
+    'imo': ('imo', 'vessel_imo', 'imo_number', 'imo number'),
+    'name': ('name', 'vessel_name', 'vessel', 'ship_name'),
+    'flag': ('flag', 'vessel_flag', 'flag_state'),
+    'vessel_type': ('type', 'vessel_type', 'ship_type'),
+}
+
+
+def valid_imo(imo):
+    """IMO ship numbers are 7 digits, the last one a check digit"""
+    digits = str(imo).strip()
+    if not (len(digits) == 7 and digits.isdigit()):
+        return False
+    return sum(int(d) * w for d, w in zip(digits[:6], range(7, 1, -1))) % 10 == int(digits[6])
+
+
+def name_key(name):
+    """Vessel name normalised for indexing: upper case, no prefix like MV/MT, single spaces"""
+    words = re.sub(r'[^A-Z0-9 ]', ' ', str(name or '').upper()).split()
+    if len(words) > 1 and words[0] in ('MV', 'MT', 'M', 'SS', 'MS'):
+        words = words[1:]
+    return ' '.join(words)
+
+
+class LRUCache:
+    """Small in-process LRU with an expiry per entry"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class VesselRegistry:
+    """Vessels in SQLite, keyed by IMO and indexed by normalised name"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.cache = LRUCache(VESSEL_CACHE_SIZE, VESSEL_CACHE_TTL)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS vessels ('
+                'imo INTEGER PRIMARY KEY, name TEXT NOT NULL, name_key TEXT NOT NULL, '
+                'flag TEXT, vessel_type TEXT, updated REAL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS vessels_name_key ON vessels (name_key)')
+
+    def _connect(self):
+        # Same rules as SqliteState: one connection per thread and process
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @staticmethod
+    def _row(row):
+        return {'imo': row[0], 'name': row[1], 'flag': row[2] or '', 'vessel_type': row[3] or ''}
+
+    def get(self, imo):
+        try:
+            imo = int(imo)
+        except (TypeError, ValueError):
+            return None
+        found = self.cache.get(imo, False)
+        if found is not False:
+            return found
+        row = self._connect().execute(
+            'SELECT imo, name, flag, vessel_type FROM vessels WHERE imo = ?', (imo,)
+        ).fetchone()
+        found = None if row is None else self._row(row)
+        self.cache.put(imo, found)  # misses are cached too, imports clear them
+        return found
+
+    def search(self, query, limit=10):
+        """Vessels whose name starts with the query, then close spellings"""
+        key = name_key(query)
+        if not key:
+            return []
+        db = self._connect()
+        # Range scan on the index: name_key >= 'ABC' AND name_key < 'ABD'
+        upper = key[:-1] + chr(ord(key[-1]) + 1)
+        rows = db.execute(
+            'SELECT imo, name, flag, vessel_type FROM vessels WHERE name_key >= ? AND name_key < ? '
+            'ORDER BY name_key LIMIT ?',
+            (key, upper, limit),
+        ).fetchall()
+        results = [self._row(row) for row in rows]
+        if len(results) >= limit or len(key) < 3:
+            return results
+
+        # Fuzzy: score names sharing a word or the first letters with the query
+        seen = {r['imo'] for r in results}
+        words = [w for w in key.split() if len(w) >= 3] or [key]
+        select = 'SELECT imo, name, flag, vessel_type, name_key FROM vessels WHERE '
+        candidates = db.execute(
+            select + ' OR '.join(['name_key LIKE ?'] * len(words)) + ' LIMIT 5000',
+            [f'%{w}%' for w in words],
+        ).fetchall()
+        candidates += db.execute(
+            select + 'name_key >= ? AND name_key < ? LIMIT 2000',
+            (key[:2], key[0] + chr(ord(key[1]) + 1)),
+        ).fetchall()
+        scored = []
+        matcher = difflib.SequenceMatcher(b=key, autojunk=False)
+        for row in candidates:
+            if row[0] in seen:
+                continue
+            seen.add(row[0])
+            matcher.set_seq1(row[4])
+            score = matcher.ratio() if matcher.real_quick_ratio() >= 0.6 else 0
+            if any(w in row[4] for w in words):
+                score += 0.5  # whole word typed correctly, e.g. 'STAR' in 'NORTHERN STAR'
+            if score >= 0.6:
+                scored.append((score, row))
+        scored.sort(key=lambda item: -item[0])
+        results.extend(self._row(row) for _, row in scored[:limit - len(results)])
+        return results[:limit]
+
+    def import_csv(self, text):
+        """Insert or update vessels from CSV text; returns counts and the first rejected rows"""
+        reader = csv.DictReader(io.StringIO(text))
+        headers = {h.strip().lower(): h for h in reader.fieldnames or []}
+        columns = {}
+        for field, aliases in VESSEL_CSV_COLUMNS.items():
+            columns[field] = next((headers[a] for a in aliases if a in headers), None)
+        if columns['imo'] is None or columns['name'] is None:
+            return {'ok': False, 'error': 'CSV needs an IMO and a name column', 'imported': 0, 'skipped': 0, 'errors': []}
+
+        now = time.time()
+        batch, errors, skipped = [], [], 0
+        for line, row in enumerate(reader, start=2):
+            imo = str(row.get(columns['imo']) or '').strip().upper().replace('IMO', '').strip()
+            name = str(row.get(columns['name']) or '').strip()
+            if not valid_imo(imo) or not name:
+                skipped += 1
+                if len(errors) < 20:
+                    errors.append({'line': line, 'imo': imo, 'name': name, 'error': 'invalid IMO' if name else 'missing name'})
+                continue
+            flag = str(row.get(columns['flag']) or '').strip() if columns['flag'] else ''
+            vessel_type = str(row.get(columns['vessel_type']) or '').strip() if columns['vessel_type'] else ''
+            batch.append((int(imo), name.upper(), name_key(name), flag, vessel_type, now))
+
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT OR REPLACE INTO vessels VALUES (?, ?, ?, ?, ?, ?)', batch)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        self.cache.clear()
+        return {'ok': True, 'imported': len(batch), 'skipped': skipped, 'errors': errors}
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM vessels').fetchone()[0]
+
+
+vessels = VesselRegistry(VESSEL_DB)
+
+
+def fill_vessel(data):
+    """Fill an empty vessel_name/vessel_flag of a request model from the registry by its IMO"""
+    if data.vessel_name and getattr(data, 'vessel_flag', True):
+        return data
+    vessel = vessels.get(data.vessel_imo)
+    if vessel:
+        if not data.vessel_name:
+            data.vessel_name = vessel['name']
+        if hasattr(data, 'vessel_flag') and not data.vessel_flag:
+            data.vessel_flag = vessel['flag']
+    return data
+
+
+def process_both(vessel_name, vessel_imo, supply_dates, mgo_tons, mgo_price, ifo_tons, ifo_price, agent, draft=None, keep_base=False):
     # Ensure template exists; if not, build a very simple one for local test
     if not os.path.exists(BOTH_TEMPLATE):
         tmp = Document()
@@ -231,19 +1812,17 @@ def process_both(vessel_name, vessel_imo, supply_dates, mgo_tons, mgo_price, ifo
         'X1_DATE': get_bunker_date(replacements.get('X1_VSLSD')) - timedelta(days=10),
     }
     in_path = BOTH_TEMPLATE
-    out_path = os.path.join(FINISHED_DIR, f"{replacements2['X1_RN']}.docx")
-    replace_strings_in_docx(in_path, out_path, replacements, 1)
-    replace_strings_in_docx(out_path, out_path, replacements2, 1)
+    out_path = finished_path(f"{replacements2['X1_RN']}.docx")
+    draft_status = render_docx(in_path, out_path, replacements, replacements2, draft, keep_base)
     input_docx = out_path
-    output_pdf = os.path.join(FINISHED_DIR, f"{replacements2['X1_RN']}.pdf")
+    output_pdf = finished_path(f"{replacements2['X1_RN']}.pdf")
     final_path = convert_docx_to_pdf(input_docx, output_pdf, LIBREOFFICE_PATH)
     if final_path.endswith('.pdf'):
         delete_file(out_path)
-    queued_up_files.append(final_path)
+    return final_path, draft_status
 
 
-def process_mgo(vessel_name, vessel_imo, supply_dates, mgo_tons, mgo_price, agent):
-    global queued_up_files
+def process_mgo(vessel_name, vessel_imo, supply_dates, mgo_tons, mgo_price, agent, draft=None, keep_base=False):
     if not os.path.exists(MGO_TEMPLATE):
         tmp = Document()
         tmp.add_heading('Bunkering nomination (MGO)', level=1)
@@ -266,19 +1845,17 @@ def process_mgo(vessel_name, vessel_imo, supply_dates, mgo_tons, mgo_price, agen
         'X1_DATE': get_bunker_date(replacements.get('X1_VSLSD')) - timedelta(days=10),
     }
     in_path = MGO_TEMPLATE
-    out_path = os.path.join(FINISHED_DIR, f"{replacements2['X1_RN']}.docx")
-    replace_strings_in_docx(in_path, out_path, replacements, 1)
-    replace_strings_in_docx(out_path, out_path, replacements2, 1)
+    out_path = finished_path(f"{replacements2['X1_RN']}.docx")
+    draft_status = render_docx(in_path, out_path, replacements, replacements2, draft, keep_base)
     input_docx = out_path
-    output_pdf = os.path.join(FINISHED_DIR, f"{replacements2['X1_RN']}.pdf")
+    output_pdf = finished_path(f"{replacements2['X1_RN']}.pdf")
     final_path = convert_docx_to_pdf(input_docx, output_pdf, LIBREOFFICE_PATH)
     if final_path.endswith('.pdf'):
         delete_file(out_path)
-    queued_up_files.append(final_path)
+    return final_path, draft_status
 
 
-def process_ifo(vessel_name, vessel_imo, supply_dates, ifo_tons, ifo_price, agent):
-    global queued_up_files
+def process_ifo(vessel_name, vessel_imo, supply_dates, ifo_tons, ifo_price, agent, draft=None, keep_base=False):
     if not os.path.exists(IFO_TEMPLATE):
         tmp = Document()
         tmp.add_heading('Bunkering nomination (IFO)', level=1)
@@ -301,15 +1878,206 @@ def process_ifo(vessel_name, vessel_imo, supply_dates, ifo_tons, ifo_price, agen
         'X1_DATE': get_bunker_date(replacements.get('X1_VSLSD')) - timedelta(days=10),
     }
     in_path = IFO_TEMPLATE
-    out_path = os.path.join(FINISHED_DIR, f"{replacements2['X1_RN']}.docx")
-    replace_strings_in_docx(in_path, out_path, replacements, 1)
-    replace_strings_in_docx(out_path, out_path, replacements2, 1)
+    out_path = finished_path(f"{replacements2['X1_RN']}.docx")
+    draft_status = render_docx(in_path, out_path, replacements, replacements2, draft, keep_base)
     input_docx = out_path
-    output_pdf = os.path.join(FINISHED_DIR, f"{replacements2['X1_RN']}.pdf")
+    output_pdf = finished_path(f"{replacements2['X1_RN']}.pdf")
     final_path = convert_docx_to_pdf(input_docx, output_pdf, LIBREOFFICE_PATH)
     if final_path.endswith('.pdf'):
         delete_file(out_path)
-    queued_up_files.append(final_path)
+    return final_path, draft_status
+
+
+# ---------------- Profiling ----------------
+PROFILE_MODES = ('cprofile', 'sampling')
+
+_profiling_lock = threading.Lock()
+_capture_lock = threading.Lock()  # one capture at a time, profilers don't nest
+_profiling_state = {'remaining': 0, 'request_ids': set(), 'mode': 'cprofile'}
+
+
+def _admin_allowed(request):
+    # No token configured means no admin access at all, not open access
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('x-admin-token') or '', ADMIN_TOKEN)
+
+
+class StackSampler(threading.Thread):
+    """Samples every thread's stack into flamegraph-ready collapsed stacks"""
+
+    def __init__(self, interval):
+        super().__init__(daemon=True, name='profile-sampler')
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def _claim_profile(request, request_id):
+    """Mode to profile this request with, or None"""
+    mode = request.headers.get('x-profile')
+    if mode:
+        if not _admin_allowed(request):
+            return None
+        return mode if mode in PROFILE_MODES else 'cprofile'
+    with _profiling_lock:
+        state = _profiling_state
+        if request_id in state['request_ids']:
+            state['request_ids'].discard(request_id)
+            return state['mode']
+        if state['remaining'] > 0 and not request.url.path.startswith('/admin/'):
+            state['remaining'] -= 1
+            return state['mode']
+    return None
+
+
+def _save_profile(request, request_id, mode, profiler, elapsed, threads=()):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', request.url.path).strip('_') or 'root'
+    rid = re.sub(r'[^A-Za-z0-9]+', '_', request_id[:12]).strip('_') or 'request'
+    stem = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{slug}-{rid}-{int(elapsed * 1000)}ms"
+    if mode == 'sampling':
+        path = os.path.join(PROFILE_DIR, f'{stem}.collapsed')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(profiler.collapsed())
+    else:
+        path = os.path.join(PROFILE_DIR, f'{stem}.prof')
+        stats = pstats.Stats(profiler)
+        for thread_profiler in threads:
+            stats.add(thread_profiler)
+        stats.dump_stats(path)
+    # Bounded ring: drop the oldest captures
+    captures = sorted(list_profiles(), key=lambda p: p['created'])
+    for old in captures[:max(0, len(captures) - PROFILE_KEEP)]:
+        delete_file(os.path.join(PROFILE_DIR, old['name']))
+    return os.path.basename(path)
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        if name.endswith(('.prof', '.collapsed')):
+            stat = os.stat(os.path.join(PROFILE_DIR, name))
+            profiles.append({'name': name, 'size': stat.st_size, 'created': stat.st_mtime})
+    return sorted(profiles, key=lambda p: p['created'], reverse=True)
+
+
+async def profile_requests(request: Request, call_next):
+    request_id = request.headers.get('x-request-id') or current_trace_id() or uuid.uuid4().hex
+    if not _capture_lock.acquire(blocking=False):
+        return await call_next(request)
+    mode = _claim_profile(request, request_id)
+    if mode is None:
+        _capture_lock.release()
+        return await call_next(request)
+    try:
+        # cProfile covers the event loop here and the request's thread pool calls and
+        # stages through profiled(); the sampler sees every thread
+        profiler = StackSampler(PROFILE_SAMPLE_INTERVAL) if mode == 'sampling' else cProfile.Profile()
+        capture = {'lock': threading.Lock(), 'threads': []}
+        token = _current_profile.set(capture if mode == 'cprofile' else None)
+        started = time.monotonic()
+        if mode == 'sampling':
+            profiler.start()
+        else:
+            profiler.enable()
+        try:
+            response = await call_next(request)
+        finally:
+            if mode == 'sampling':
+                profiler.stop()
+            else:
+                profiler.disable()
+            _current_profile.reset(token)
+        # A failed capture must never replace the handler's response
+        try:
+            with capture['lock']:
+                threads = list(capture['threads'])
+            name = _save_profile(request, request_id, mode, profiler, time.monotonic() - started, threads)
+        except Exception as e:
+            name = None
+            print(f'[PROFILE] Failed to save capture for {request.url.path}: {e}')
+    finally:
+        _capture_lock.release()
+    if name:
+        response.headers['X-Profile-Id'] = name
+    return response
+
+
+async def trace_requests(request: Request, call_next):
+    """Trace every request under its correlation id, returned as X-Request-ID"""
+    trace = start_trace(request.headers.get('x-request-id'), method=request.method, path=request.url.path)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        record = finish_trace(trace, status=status)
+        await run_in_threadpool(save_trace, record)
+    if record['duration_ms'] > 5000:
+        print(f"[TRACE] {request.method} {request.url.path} took {record['duration_ms'] / 1000:.1f}s ({trace['trace_id']})")
+    response.headers['X-Request-ID'] = trace['trace_id']
+    return response
+
+
+# ---------------- Idempotency ----------------
+async def idempotent_requests(request: Request, call_next):
+    """Replay the stored response for a POST repeated with the same Idempotency-Key"""
+    idempotency_key = request.headers.get('idempotency-key')
+    if request.method != 'POST' or not idempotency_key:
+        return await call_next(request)
+    key = f'{request.url.path}|{idempotency_key}'
+    # SQLite calls wait on other workers' writes; keep them off the event loop
+    stored = await run_in_threadpool(shared.get, 'idempotency', key)
+    if stored is None and await run_in_threadpool(shared.add, 'idempotency', key, {'pending': True}, ttl=min(600, IDEMPOTENCY_TTL)):
+        try:
+            response = await call_next(request)
+            body = b''.join([chunk async for chunk in response.body_iterator])
+        except Exception:
+            await run_in_threadpool(shared.delete, 'idempotency', key)
+            raise
+        if response.status_code < 500:
+            await run_in_threadpool(shared.put, 'idempotency', key, {
+                'status': response.status_code,
+                'media_type': response.headers.get('content-type'),
+                'body': body.decode('utf-8', 'replace'),
+            }, ttl=IDEMPOTENCY_TTL)
+        else:
+            await run_in_threadpool(shared.delete, 'idempotency', key)
+        return Response(content=body, status_code=response.status_code, headers=dict(response.headers))
+    stored = stored or await run_in_threadpool(shared.get, 'idempotency', key)
+    if stored is None or stored.get('pending'):
+        return JSONResponse({'ok': False, 'error': 'A request with this Idempotency-Key is still in progress'}, status_code=409)
+    return Response(
+        content=stored['body'],
+        status_code=stored['status'],
+        media_type=stored['media_type'],
+        headers={'Idempotent-Replay': 'true'},
+    )
 
 
 app = FastAPI()
@@ -321,8 +2089,40 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Profile-Id", "Idempotent-Replay"],
 )
 
+app.middleware('http')(idempotent_requests)
+if PROFILING:
+    app.middleware('http')(profile_requests)
+if TRACING:
+    # Outermost, so the profiler and idempotent replays run inside the trace
+    app.middleware('http')(trace_requests)
+
+@app.on_event('startup')
+def start_janitor():
+    if JANITOR_INTERVAL > 0:
+        threading.Thread(target=_janitor_loop, daemon=True, name='janitor').start()
+
+
+@app.on_event('shutdown')
+def flush_pending_emails():
+    # Don't lose buffered digests on restart
+    flush_all_digests()
+    _janitor_stop.set()
+
+
+@app.on_event('startup')
+async def prepare_connections():
+    if ASYNC_IO:
+        await run_in_threadpool(prepare_s3_async)
+
+
+@app.on_event('shutdown')
+async def close_connections():
+    await close_async_http()
+
+
 class get_nom_info(BaseModel):
     vessel_name: str | None = ""
     vessel_imo: int | None = 0
@@ -344,9 +2144,12 @@ def root():
 @app.get('/download/{filename}')
 async def download_file(filename: str):
     """Download a generated file"""
-    file_path = os.path.join(FINISHED_DIR, filename)
-    if not os.path.exists(file_path):
-        return {'error': 'File not found'}, 404
+    file_path = find_finished(filename)
+    if file_path is None:
+        # Generated on another host: fetch it from S3
+        file_path = await run_in_threadpool(fetch_from_s3, filename)
+    if file_path is None:
+        return JSONResponse({'error': 'File not found'}, status_code=404)
     return FileResponse(
         file_path,
         media_type='application/pdf' if filename.endswith('.pdf') else 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
@@ -354,30 +2157,48 @@ async def download_file(filename: str):
     )
 
 
-def process_noms(full_vessel_data):
-    global queued_up_files
-    queued_up_files = []
+def nomination_kind(mgo_tons, ifo_tons):
+    """Which nomination template applies: 'mgo', 'ifo', 'both' or None"""
+    if (mgo_tons != '0') and (ifo_tons == '0'):
+        return 'mgo'
+    if (mgo_tons == '0') and (ifo_tons != '0'):
+        return 'ifo'
+    if (mgo_tons != '0') and (ifo_tons != '0'):
+        return 'both'
+    return None
+
 
-    if (full_vessel_data['mgo_tons'] != '0') and (full_vessel_data['ifo_tons'] == '0'):
-        process_mgo(
+def render_nomination(full_vessel_data, draft=None, keep_base=False):
+    """Render the MGO/IFO/both nomination for one vessel.
+
+    Returns (files, draft_status) where draft_status says whether a pre-rendered
+    draft was used ('hit', 'patched') or not (None).
+    """
+    kind = nomination_kind(full_vessel_data['mgo_tons'], full_vessel_data['ifo_tons'])
+    if kind == 'mgo':
+        final_path, draft_status = process_mgo(
             vessel_name=full_vessel_data['vessel_name'],
             vessel_imo=full_vessel_data['vessel_imo'],
             supply_dates=full_vessel_data['vessel_supply_date'],
             mgo_tons=full_vessel_data['mgo_tons'],
             mgo_price=full_vessel_data['mgo_price'],
             agent=full_vessel_data['vessel_agent'],
+            draft=draft,
+            keep_base=keep_base,
         )
-    elif (full_vessel_data['mgo_tons'] == '0') and (full_vessel_data['ifo_tons'] != '0'):
-        process_ifo(
+    elif kind == 'ifo':
+        final_path, draft_status = process_ifo(
             vessel_name=full_vessel_data['vessel_name'],
             vessel_imo=full_vessel_data['vessel_imo'],
             supply_dates=full_vessel_data['vessel_supply_date'],
             ifo_tons=full_vessel_data['ifo_tons'],
             ifo_price=full_vessel_data['ifo_price'],
             agent=full_vessel_data['vessel_agent'],
+            draft=draft,
+            keep_base=keep_base,
         )
-    elif (full_vessel_data['mgo_tons'] != '0') and (full_vessel_data['ifo_tons'] != '0'):
-        process_both(
+    elif kind == 'both':
+        final_path, draft_status = process_both(
             vessel_name=full_vessel_data['vessel_name'],
             vessel_imo=full_vessel_data['vessel_imo'],
             supply_dates=full_vessel_data['vessel_supply_date'],
@@ -386,60 +2207,211 @@ def process_noms(full_vessel_data):
             ifo_tons=full_vessel_data['ifo_tons'],
             ifo_price=full_vessel_data['ifo_price'],
             agent=full_vessel_data['vessel_agent'],
+            draft=draft,
+            keep_base=keep_base,
         )
+    else:
+        return [], None
+    return [final_path], draft_status
+
 
-    fetched_email_body = (
-        f"Dear Simple Fuel FZCO,\n\nKindly find the below attached nomination for the vessel:\n\n"
-        f"- mv {full_vessel_data['vessel_name']} : IMO {full_vessel_data['vessel_imo']} : supply on {full_vessel_data['vessel_supply_date']}\n\n"
-        f"Warm regards"
+def nomination_email(vessels):
+    """Build (subject, body) for a nomination email covering one or more vessels"""
+    lines = ''.join(
+        f"- mv {v['vessel_name']} : IMO {v['vessel_imo']} : supply on {v['vessel_supply_date']}\n"
+        for v in vessels
     )
-    fetched_email_subject = f"NOMINATION FOR VESSEL: {full_vessel_data['vessel_name']} (IMO: {full_vessel_data['vessel_imo']})"
+    if len(vessels) == 1:
+        intro = 'Kindly find the below attached nomination for the vessel:'
+        subject = f"NOMINATION FOR VESSEL: {vessels[0]['vessel_name']} (IMO: {vessels[0]['vessel_imo']})"
+    else:
+        intro = 'Kindly find the below attached nominations for the vessels:'
+        subject = f"NOMINATION FOR {len(vessels)} VESSELS"
+    body = f"Dear Simple Fuel FZCO,\n\n{intro}\n\n{lines}\nWarm regards"
+    return subject, body
+
+
+def render_nomination_from_draft(full_vessel_data):
+    """render_nomination from the vessel's draft or earlier base, keeping a new base"""
+    kind = nomination_kind(full_vessel_data['mgo_tons'], full_vessel_data['ifo_tons'])
+    # find_draft waits on the shared 'drafts' lock, so this runs in a worker thread
+    draft = find_draft(kind, full_vessel_data['vessel_name']) if kind else None
+    return render_nomination(full_vessel_data, draft, True)
+
+
+async def process_noms(full_vessel_data):
+    queued_up_files, draft_status = await run_in_threadpool(render_nomination_from_draft, full_vessel_data)
+
+    fetched_email_subject, fetched_email_body = nomination_email([full_vessel_data])
     # Send to both PEN_EMAIL and TEST_EMAIL
     recipients = [PEN_EMAIL, TEST_EMAIL] if TEST_EMAIL else [PEN_EMAIL]
-    send_email(recipients=recipients, subject=fetched_email_subject, body=fetched_email_body, attachments=queued_up_files)
+    files = list(queued_up_files)
+
+    # render -> convert is done above; email, S3 and ledger only depend on the files
+    stages = await run_stages_async({
+        'email': (send_email_async(recipients=recipients, subject=fetched_email_subject, body=fetched_email_body, attachments=files, kind='nomination'), EMAIL_TIMEOUT),
+        's3': (upload_files_to_s3_async(files), S3_TIMEOUT),
+        'ledger': (lambda: write_ledger({'kind': 'nomination', 'vessel_name': full_vessel_data['vessel_name'], 'vessel_imo': full_vessel_data['vessel_imo'], 'files': [os.path.basename(p) for p in files]}), LEDGER_TIMEOUT),
+    })
+    return {
+        'local_files': files,
+        's3_files': stages['s3']['result'] or [],
+        'stages': stages,
+        'draft': draft_status,
+    }
+
 
-    s3_files = upload_files_to_s3(queued_up_files)
+def nomination_data_from(item):
+    """Normalise a get_nom_info payload into the dict used by the render pipeline"""
+    fill_vessel(item)
     return {
-        'local_files': queued_up_files,
-        's3_files': s3_files,
+        'vessel_name': str(item.vessel_name or ''),
+        'vessel_imo': int(item.vessel_imo),
+        'vessel_port': str(item.vessel_port),
+        'mgo_tons': str(item.mgo_tons),
+        'mgo_price': float(item.mgo_price),
+        'ifo_tons': str(item.ifo_tons),
+        'ifo_price': float(item.ifo_price),
+        'vessel_supply_date': str(item.vessel_supply_date),
+        'vessel_trader': str(item.vessel_trader),
+        'vessel_agent': str(item.vessel_agent),
     }
 
 
 @app.post('/endpoint1')
 async def endpoint1(item: get_nom_info):
-    vessel_name = str(item.vessel_name)
-    vessel_imo = int(item.vessel_imo)
-    vessel_port = str(item.vessel_port)
-    mgo_tons = str(item.mgo_tons)
-    mgo_price = float(item.mgo_price)
-    ifo_tons = str(item.ifo_tons)
-    ifo_price = float(item.ifo_price)
-    vessel_supply_date = str(item.vessel_supply_date)
-    vessel_trader = str(item.vessel_trader)
-    vessel_agent = str(item.vessel_agent)
-
-    nomination_data = {
-        'vessel_name': vessel_name,
-        'vessel_imo': vessel_imo,
-        'vessel_port': vessel_port,
-        'mgo_tons': mgo_tons,
-        'mgo_price': mgo_price,
-        'ifo_tons': ifo_tons,
-        'ifo_price': ifo_price,
-        'vessel_supply_date': vessel_supply_date,
-        'vessel_trader': vessel_trader,
-        'vessel_agent': vessel_agent
-    }
+    nomination_data = nomination_data_from(item)
+    if not nomination_data['vessel_name']:
+        return {'ok': False, 'error': f"Unknown vessel IMO {nomination_data['vessel_imo']}", 'message': 'Enter the vessel name or import the vessel first'}
 
     print(nomination_data)
-    result = process_noms(nomination_data)
-    return {'ok': True, 'received': nomination_data, 'files': result.get('s3_files') or [], 'local_files': result.get('local_files') or []}
+    result = await process_noms(nomination_data)
+    return {'ok': True, 'received': nomination_data, 'files': result.get('s3_files') or [], 'local_files': result.get('local_files') or [], 'stages': result.get('stages') or {}, 'draft': result.get('draft')}
+
+
+def nomination_reference(full_vessel_data):
+    """The X1_RN a nomination renders under, which also names its files"""
+    bunker_date = get_bunker_date(full_vessel_data['vessel_supply_date'])
+    return bunker_date.strftime('%Y%m%d') + '-NOM-' + str(full_vessel_data['vessel_name']).upper().replace(' ', '_')
+
+
+def render_fleet_nomination(full_vessel_data):
+    """render_nomination for the fleet process pool; returns (files, bases to register)"""
+    global _collected_bases
+    _collected_bases = []
+    try:
+        files, _ = render_nomination(full_vessel_data, keep_base=True)
+        return files, _collected_bases
+    finally:
+        _collected_bases = None
+
+
+_render_pool = None
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        # Never fork: this process already runs the stage/draft/janitor threads and holds SQLite connections
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _render_pool = ProcessPoolExecutor(max_workers=FLEET_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _render_pool
+
+
+def process_fleet(fleet_data, email_mode='consolidated'):
+    """Render nominations for many vessels in parallel, then email/upload/record them"""
+    pool = get_render_pool()
+    started = time.monotonic()
+    futures = [pool.submit(render_fleet_nomination, data) for data in fleet_data]
+
+    vessels = []
+    for data, future in zip(fleet_data, futures):
+        entry = {'vessel_name': data['vessel_name'], 'vessel_imo': data['vessel_imo'], 'ok': False, 'local_files': [], 's3_files': [], 'emailed': False, 'error': None}
+        remaining = max(0.0, started + FLEET_RENDER_TIMEOUT - time.monotonic())
+        try:
+            entry['local_files'], bases = future.result(timeout=remaining)
+            entry['ok'] = True
+            # Registered here so /final-nomination finds fleet nominations too
+            for base in bases:
+                try:
+                    register_base(*base)
+                except Exception as e:
+                    print(f"[FLEET] Could not keep base for {data['vessel_name']}: {e}")
+        except FutureTimeout:
+            entry['error'] = f'Render timed out after {FLEET_RENDER_TIMEOUT}s'
+        except Exception as e:
+            entry['error'] = str(e)
+        if entry['error']:
+            print(f"[FLEET] Render failed for {data['vessel_name']}: {entry['error']}")
+        vessels.append(entry)
+
+    rendered = [(data, v) for data, v in zip(fleet_data, vessels) if v['ok'] and v['local_files']]
+    files = [path for _, v in rendered for path in v['local_files']]
+    recipients = [PEN_EMAIL, TEST_EMAIL] if TEST_EMAIL else [PEN_EMAIL]
+
+    stages = {
+        's3': (lambda: upload_files_to_s3(files), S3_TIMEOUT),
+        'ledger': (lambda: [
+            write_ledger({'kind': 'nomination', 'vessel_name': data['vessel_name'], 'vessel_imo': data['vessel_imo'], 'files': [os.path.basename(p) for p in v['local_files']]})
+            for data, v in rendered
+        ], LEDGER_TIMEOUT),
+    }
+    if email_mode == 'per_vessel':
+        for i, (data, v) in enumerate(rendered):
+            subject, body = nomination_email([data])
+            attachments = v['local_files']
+            stages[f'email:{i}'] = (lambda subject=subject, body=body, attachments=attachments: send_email(recipients=recipients, subject=subject, body=body, attachments=attachments, kind='nomination'), EMAIL_TIMEOUT)
+    elif rendered:
+        subject, body = nomination_email([data for data, _ in rendered])
+        stages['email'] = (lambda: send_email(recipients=recipients, subject=subject, body=body, attachments=files, kind='nomination'), EMAIL_TIMEOUT)
+    stage_results = run_stages(stages)
+
+    # Attach each vessel's S3 links and email outcome to its own result
+    s3_by_name = {os.path.basename(item['key']): item for item in stage_results['s3']['result'] or []}
+    for i, (_, v) in enumerate(rendered):
+        v['s3_files'] = [s3_by_name[os.path.basename(p)] for p in v['local_files'] if os.path.basename(p) in s3_by_name]
+        email_stage = stage_results.get(f'email:{i}') or stage_results.get('email')
+        v['emailed'] = bool(email_stage and email_stage['ok'])
+    return {'vessels': vessels, 'stages': stage_results}
+
+
+class FleetNomination(BaseModel):
+    vessels: List[get_nom_info]
+    email_mode: str = 'consolidated'  # 'consolidated' or 'per_vessel'
+
+
+@app.post('/fleet-nomination')
+async def fleet_nomination(fleet: FleetNomination):
+    """Render and send nominations for a whole fleet stem in one call"""
+    if fleet.email_mode not in ('consolidated', 'per_vessel'):
+        return {'ok': False, 'error': f'Unknown email_mode: {fleet.email_mode}'}
+    if len(fleet.vessels) > FLEET_MAX_VESSELS:
+        return {'ok': False, 'error': f'Too many vessels ({len(fleet.vessels)} > {FLEET_MAX_VESSELS})'}
+    fleet_data = [nomination_data_from(item) for item in fleet.vessels]
+    unknown = [data['vessel_imo'] for data in fleet_data if not data['vessel_name']]
+    if unknown:
+        return {'ok': False, 'error': f"Unknown vessel IMO {', '.join(str(imo) for imo in unknown)}", 'message': 'Enter the vessel name or import the vessel first'}
+    # Same vessel and date render to the same file; parallel renders would overwrite each other
+    references = Counter()
+    for data in fleet_data:
+        try:
+            references[nomination_reference(data)] += 1
+        except (ValueError, IndexError):
+            pass  # bad date, reported by that vessel's render
+    duplicates = sorted(ref for ref, count in references.items() if count > 1)
+    if duplicates:
+        return {'ok': False, 'error': f"Duplicate nominations in fleet: {', '.join(duplicates)}", 'message': 'Each vessel and supply date may appear only once'}
+    # Waiting on the process pool must not block the event loop
+    result = await run_in_threadpool(process_fleet, fleet_data, fleet.email_mode)
+    return {
+        'ok': all(v['ok'] for v in result['vessels']),
+        'vessels': result['vessels'],
+        'stages': result['stages'],
+    }
 
 
 class InvoiceData(BaseModel):
-    vessel_name: str
+    vessel_name: str = ""  # empty = looked up from vessel_imo
     vessel_imo: int
-    vessel_flag: str
+    vessel_flag: str = ""
     vessel_port: str
     bdn_numbers: str
     mgo_tons: str = "0"
@@ -485,13 +2457,36 @@ def determine_bank(dict_):
     return [bank_name, bank_account_number, bank_acccount_iban, bank_swift_code]
 
 
+def render_invoice(in_path, output_filename, replacements, replacements2):
+    """Apply both replacement passes to an invoice template and convert it to PDF"""
+    out_path = finished_path(f"{output_filename}.docx")
+
+    # Apply replacements in two passes (matches notebook)
+    with span('render.pass', step='replacements', template=os.path.basename(in_path)):
+        replace_strings_in_docx(in_path, out_path, replacements, 1)
+    with span('render.pass', step='replacements2'):
+        replace_strings_in_docx(out_path, out_path, replacements2, 1)
+
+    # Convert to PDF
+    output_pdf = finished_path(f"{output_filename}.pdf")
+    final_path = convert_docx_to_pdf(out_path, output_pdf, LIBREOFFICE_PATH)
+
+    # Delete DOCX if PDF created successfully
+    if final_path.endswith('.pdf'):
+        delete_file(out_path)
+    return final_path
+
+
 @app.post('/generate-invoice')
 async def generate_invoice(invoice_data: InvoiceData):
     """Generate invoice PDF - matches temp_file2.ipynb exactly"""
-    global queued_up_files
     queued_up_files = []
     
     try:
+        fill_vessel(invoice_data)
+        if not invoice_data.vessel_name:
+            return {'ok': False, 'error': f'Unknown vessel IMO {invoice_data.vessel_imo}', 'message': 'Enter the vessel name or import the vessel first'}
+
         # Determine template - matches notebook logic
         has_mgo = invoice_data.mgo_tons and invoice_data.mgo_tons != "0" and float(invoice_data.mgo_tons) > 0
         has_ifo = invoice_data.ifo_tons and invoice_data.ifo_tons != "0" and float(invoice_data.ifo_tons) > 0
@@ -578,33 +2573,40 @@ async def generate_invoice(invoice_data: InvoiceData):
         if not os.path.exists(in_path):
             return {'ok': False, 'error': f'Template not found: {in_path}'}
         
-        # Generate file
-        output_filename = replacements2['X1_RN']
-        out_path = os.path.join(FINISHED_DIR, f"{output_filename}.docx")
-        
-        # Apply replacements in two passes (matches notebook)
-        replace_strings_in_docx(in_path, out_path, replacements, 1)
-        replace_strings_in_docx(out_path, out_path, replacements2, 1)
-        
-        # Convert to PDF
-        input_docx = out_path
-        output_pdf = os.path.join(FINISHED_DIR, f"{output_filename}.pdf")
-        final_path = convert_docx_to_pdf(input_docx, output_pdf, LIBREOFFICE_PATH)
-        
-        # Delete DOCX if PDF created successfully
-        if final_path.endswith('.pdf'):
-            delete_file(out_path)
-            
+        # Generate file; python-docx and soffice block, so off the event loop
+        final_path = await run_in_threadpool(render_invoice, in_path, replacements2['X1_RN'], replacements, replacements2)
+
         queued_up_files.append(final_path)
+        files = list(queued_up_files)
         
-        # Upload to S3 if configured
-        s3_files = upload_files_to_s3(queued_up_files)
+        # Upload to S3 (if configured) and record in the ledger in parallel
+        stages = await run_stages_async({
+            's3': (upload_files_to_s3_async(files), S3_TIMEOUT),
+            'ledger': (lambda: write_ledger({
+                'kind': 'invoice',
+                'reference': replacements2['X1_RN'],
+                'company_name': invoice_data.company_name,
+                'vessel_name': invoice_data.vessel_name,
+                'vessel_imo': invoice_data.vessel_imo,
+                'supply_date': invoice_data.supply_date,
+                'bdn_numbers': invoice_data.bdn_numbers,
+                'mgo_tons': invoice_data.mgo_tons if has_mgo else '0',
+                'mgo_price': str(invoice_data.mgo_price),
+                'ifo_tons': invoice_data.ifo_tons if has_ifo else '0',
+                'ifo_price': str(invoice_data.ifo_price),
+                'currency': invoice_data.currency,
+                'exchange_rate': str(invoice_data.exchange_rate),
+                'total': replacements2['X1_TOTAL'],
+                'files': [os.path.basename(p) for p in files],
+            }), LEDGER_TIMEOUT),
+        })
         
         return {
             'ok': True,
             'message': 'Invoice generated successfully',
-            'local_files': queued_up_files,
-            's3_files': s3_files,
+            'local_files': files,
+            's3_files': stages['s3']['result'] or [],
+            'stages': stages,
             'filename': os.path.basename(final_path)
         }
     except Exception as e:
@@ -613,6 +2615,242 @@ async def generate_invoice(invoice_data: InvoiceData):
         return {'ok': False, 'error': str(e), 'message': f'Failed to generate invoice: {str(e)}'}
 
 
+# ---------------- Customer statements ----------------
+STATEMENT_COLUMNS = (
+    'reference', 'company_name', 'vessel_name', 'vessel_imo', 'supply_date', 'bdn_numbers',
+    'mgo_tons', 'mgo_price', 'ifo_tons', 'ifo_price', 'currency', 'exchange_rate',
+)
+CENT = Decimal('0.01')
+
+
+def _decimal(value):
+    value = str(value).strip().replace(',', '') if value is not None else ''
+    number = Decimal(value) if value else Decimal(0)
+    if not number.is_finite():
+        # Infinity/NaN parse, but quantize() would fail on them later
+        raise ValueError(f'Not a finite number: {value}')
+    return number
+
+
+def _parse_day(value):
+    value = str(value or '').strip()
+    for fmt in ('%d.%m.%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    return get_bunker_date(value)
+
+
+def invoice_lines_from_csv(text):
+    """Rows of a CSV export with InvoiceData columns"""
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def invoice_lines_from_ledger():
+    """Invoice lines recorded by /generate-invoice"""
+    rows = []
+    if not os.path.exists(LEDGER_FILE):
+        return rows
+    with open(LEDGER_FILE, encoding='utf-8') as f:
+        for line in f:
+            if '"invoice"' not in line:
+                continue
+            record = json.loads(line)
+            if record.get('kind') == 'invoice' and 'mgo_tons' in record:
+                rows.append(record)
+    return rows
+
+
+def build_statement(rows, company_name=None, date_from=None, date_to=None):
+    """Totals for many invoice lines, computed column by column in exact Decimal.
+
+    Line totals follow generate_invoice (tons x price x exchange rate) and are
+    rounded half-up to cents; subtotals are sums of the rounded lines, so the
+    statement adds up line by line.
+    """
+    # Columns first, so each computation below is one pass over plain lists
+    columns = {name: [row.get(name) for row in rows] for name in STATEMENT_COLUMNS}
+    count = len(rows)
+    errors = []
+    keep = [True] * count
+
+    def column(name, convert):
+        values = []
+        for i, raw in enumerate(columns[name]):
+            if not keep[i]:
+                values.append(None)
+                continue
+            try:
+                values.append(convert(raw))
+            except (InvalidOperation, ValueError, IndexError) as e:
+                keep[i] = False
+                errors.append({'line': i + 1, 'column': name, 'value': raw, 'error': str(e) or type(e).__name__})
+                values.append(None)
+        return values
+
+    mgo_tons = column('mgo_tons', _decimal)
+    mgo_price = column('mgo_price', _decimal)
+    ifo_tons = column('ifo_tons', _decimal)
+    ifo_price = column('ifo_price', _decimal)
+    rates = column('exchange_rate', lambda v: _decimal(v) if str(v or '').strip() else Decimal(1))
+    days = column('supply_date', _parse_day)
+    currencies = [str(c or 'USD').strip().upper() or 'USD' for c in columns['currency']]
+    companies = [str(c or '').strip() for c in columns['company_name']]
+
+    wanted_company = company_name.strip().upper() if company_name else None
+    start = _parse_day(date_from) if date_from else None
+    end = _parse_day(date_to) if date_to else None
+    selected = [
+        i for i in range(count)
+        if keep[i]
+        and (wanted_company is None or companies[i].upper() == wanted_company)
+        and (start is None or days[i] >= start)
+        and (end is None or days[i] <= end)
+    ]
+
+    mgo_totals = {i: (mgo_tons[i] * mgo_price[i] * rates[i]).quantize(CENT, ROUND_HALF_UP) for i in selected}
+    ifo_totals = {i: (ifo_tons[i] * ifo_price[i] * rates[i]).quantize(CENT, ROUND_HALF_UP) for i in selected}
+
+    # Bank routing depends only on the currency: resolve each currency once
+    banks = {cur: determine_bank({'X1_UC': cur}) for cur in {currencies[i] for i in selected}}
+    subtotals = {}
+    for i in selected:
+        entry = subtotals.setdefault(currencies[i], {
+            'lines': 0, 'mgo_tons': Decimal(0), 'ifo_tons': Decimal(0),
+            'mgo_total': Decimal(0), 'ifo_total': Decimal(0), 'total': Decimal(0),
+        })
+        entry['lines'] += 1
+        entry['mgo_tons'] += mgo_tons[i]
+        entry['ifo_tons'] += ifo_tons[i]
+        entry['mgo_total'] += mgo_totals[i]
+        entry['ifo_total'] += ifo_totals[i]
+        entry['total'] += mgo_totals[i] + ifo_totals[i]
+    for cur, entry in subtotals.items():
+        bank = banks[cur]
+        entry['bank'] = {'name': bank[0], 'account_number': bank[1], 'iban': bank[2], 'swift': bank[3]}
+
+    lines = [
+        {
+            'reference': columns['reference'][i] or '',
+            'vessel_name': columns['vessel_name'][i] or '',
+            'vessel_imo': columns['vessel_imo'][i] or '',
+            'supply_date': days[i],
+            'bdn_numbers': columns['bdn_numbers'][i] or '',
+            'currency': currencies[i],
+            'mgo_total': mgo_totals[i],
+            'ifo_total': ifo_totals[i],
+            'total': mgo_totals[i] + ifo_totals[i],
+        }
+        for i in sorted(selected, key=lambda i: (days[i], currencies[i]))
+    ]
+    return {'lines': lines, 'subtotals': subtotals, 'errors': errors, 'rows_read': count}
+
+
+def render_statement(statement, company_name, date_from=None, date_to=None):
+    """Write the statement DOCX/PDF and the full line listing as CSV; returns the file paths"""
+    stamp = date.today().strftime('%Y%m%d')
+    slug = re.sub(r'[^A-Z0-9]+', '_', str(company_name or 'ALL').upper()).strip('_') or 'ALL'
+    name = f"{stamp}-STMT-{slug}"
+
+    csv_path = finished_path(f'{name}.csv')
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['reference', 'vessel_name', 'vessel_imo', 'supply_date', 'bdn_numbers', 'currency', 'mgo_total', 'ifo_total', 'total'])
+        for line in statement['lines']:
+            writer.writerow([
+                line['reference'], line['vessel_name'], line['vessel_imo'], line['supply_date'].strftime('%d.%m.%Y'),
+                line['bdn_numbers'], line['currency'], line['mgo_total'], line['ifo_total'], line['total'],
+            ])
+
+    doc = Document()
+    doc.add_heading('Statement of Account', level=1)
+    doc.add_paragraph(f"Customer: {str(company_name or 'All customers').upper()}")
+    period = f"{date_from or 'start'} to {date_to or date.today().strftime('%d.%m.%Y')}"
+    doc.add_paragraph(f"Period: {period}")
+
+    doc.add_heading('Totals by currency', level=2)
+    table = doc.add_table(rows=1, cols=6)
+    for cell, title in zip(table.rows[0].cells, ('Currency', 'Invoices', 'MGO', 'IFO', 'Total', 'Pay to')):
+        cell.text = title
+    for cur, entry in sorted(statement['subtotals'].items()):
+        cells = table.add_row().cells
+        cells[0].text = cur
+        cells[1].text = str(entry['lines'])
+        cells[2].text = f"{entry['mgo_total']:,.2f}"
+        cells[3].text = f"{entry['ifo_total']:,.2f}"
+        cells[4].text = f"{entry['total']:,.2f}"
+        cells[5].text = f"{entry['bank']['name']} / IBAN {entry['bank']['iban']} / SWIFT {entry['bank']['swift']}"
+
+    lines = statement['lines']
+    doc.add_heading('Invoices', level=2)
+    if len(lines) > STATEMENT_MAX_LINES:
+        doc.add_paragraph(f'Showing the latest {STATEMENT_MAX_LINES} of {len(lines)} invoices; the attached CSV lists all of them.')
+        lines = lines[-STATEMENT_MAX_LINES:]
+    table = doc.add_table(rows=1, cols=6)
+    for cell, title in zip(table.rows[0].cells, ('Date', 'Reference', 'Vessel', 'BDN', 'Currency', 'Total')):
+        cell.text = title
+    for line in lines:
+        cells = table.add_row().cells
+        cells[0].text = line['supply_date'].strftime('%d.%m.%Y')
+        cells[1].text = str(line['reference'])
+        cells[2].text = str(line['vessel_name']).upper()
+        cells[3].text = str(line['bdn_numbers'])
+        cells[4].text = line['currency']
+        cells[5].text = f"{line['total']:,.2f}"
+
+    out_path = finished_path(f'{name}.docx')
+    doc.save(out_path)
+    final_path = convert_docx_to_pdf(out_path, finished_path(f'{name}.pdf'), LIBREOFFICE_PATH)
+    if final_path.endswith('.pdf'):
+        delete_file(out_path)
+    return [final_path, csv_path]
+
+
+class StatementRequest(BaseModel):
+    company_name: str | None = None  # None = all customers
+    date_from: str | None = None  # DD.MM.YYYY or YYYY-MM-DD
+    date_to: str | None = None
+    csv_text: str | None = None  # InvoiceData columns; default is the invoice ledger
+
+
+@app.post('/statement')
+async def statement(request_data: StatementRequest):
+    """Build a customer statement from many invoices"""
+    try:
+        started = time.monotonic()
+        if request_data.csv_text:
+            rows = await run_in_threadpool(invoice_lines_from_csv, request_data.csv_text)
+        else:
+            rows = await run_in_threadpool(invoice_lines_from_ledger)
+        result = await run_in_threadpool(build_statement, rows, request_data.company_name, request_data.date_from, request_data.date_to)
+        computed = time.monotonic()
+        if not result['lines']:
+            return {'ok': False, 'error': 'No invoices match', 'rows_read': result['rows_read'], 'errors': result['errors'][:20]}
+        files = await run_in_threadpool(render_statement, result, request_data.company_name, request_data.date_from, request_data.date_to)
+        stages = await run_stages_async({
+            's3': (upload_files_to_s3_async(files), S3_TIMEOUT),
+            'ledger': (lambda: write_ledger({'kind': 'statement', 'company_name': request_data.company_name, 'lines': len(result['lines']), 'files': [os.path.basename(p) for p in files]}), LEDGER_TIMEOUT),
+        })
+        return {
+            'ok': True,
+            'rows_read': result['rows_read'],
+            'lines': len(result['lines']),
+            'subtotals': {
+                cur: {k: str(v) if isinstance(v, Decimal) else v for k, v in entry.items()}
+                for cur, entry in result['subtotals'].items()
+            },
+            'errors': result['errors'][:20],
+            'error_count': len(result['errors']),
+            'local_files': files,
+            's3_files': stages['s3']['result'] or [],
+            'filename': os.path.basename(files[0]),
+            'timing': {'compute_ms': round((computed - started) * 1000, 1), 'render_ms': round((time.monotonic() - computed) * 1000, 1)},
+        }
+    except Exception as e:
+        return {'ok': False, 'error': str(e), 'message': f'Failed to build statement: {str(e)}'}
+
+
 class InitialRequest(BaseModel):
     vessel_name: str
     mgo_tons: str
@@ -622,12 +2860,16 @@ class InitialRequest(BaseModel):
     port: str
     agent_name: str
     full_order_text: str
+    prerender: bool = True
 
 
 @app.post('/initial-request')
 async def initial_request(request_data: InitialRequest):
     """Send initial bunker request email"""
     try:
+        # Pre-render the expected nomination in the background while we email
+        draft_scheduled = PRERENDER_DRAFTS and request_data.prerender and await run_in_threadpool(schedule_draft, request_data)
+
         # Compose email with request details
         email_body = f"""Dear Simple Fuel FZCO,
 
@@ -641,32 +2883,37 @@ Best regards"""
         
         # Send email (will skip if DISABLE_EMAIL=1 or token missing)
         recipients = [PEN_EMAIL, TEST_EMAIL] if TEST_EMAIL else [PEN_EMAIL]
-        send_email(
+        await send_email_async(
             recipients=recipients,
             subject=email_subject,
             body=email_body,
-            attachments=[]
+            attachments=[],
+            kind='initial_request'
         )
         
         return {
             'ok': True,
             'message': 'Initial request email sent successfully',
-            'data': request_data.dict()
+            'data': request_data.dict(),
+            'draft_scheduled': bool(draft_scheduled),
         }
     except Exception as e:
         return {'ok': False, 'error': str(e), 'message': f'Failed to send email: {str(e)}'}
 
 
 class FirstNominationData(BaseModel):
-    vessel_name: str
+    vessel_name: str = ""  # empty = looked up from vessel_imo
     vessel_imo: int
-    vessel_flag: str
+    vessel_flag: str = ""
 
 
 @app.post('/first-nomination')
 async def first_nomination(nom_data: FirstNominationData):
     """Generate and email first nomination with basic vessel info"""
     try:
+        fill_vessel(nom_data)
+        if not nom_data.vessel_name:
+            return {'ok': False, 'error': f'Unknown vessel IMO {nom_data.vessel_imo}', 'message': 'Enter the vessel name or import the vessel first'}
         email_body = f"""Dear Simple Fuel FZCO,
 
 Please find our first nomination for:
@@ -681,11 +2928,12 @@ Best regards"""
         
         email_subject = f"FIRST NOMINATION - {nom_data.vessel_name} (IMO: {nom_data.vessel_imo})"
         
-        send_email(
+        await send_email_async(
             recipients=[PEN_EMAIL],
             subject=email_subject,
             body=email_body,
-            attachments=[]
+            attachments=[],
+            kind='first_nomination'
         )
         
         return {
@@ -697,6 +2945,35 @@ Best regards"""
         return {'ok': False, 'error': str(e), 'message': f'Failed to send: {str(e)}'}
 
 
+class VesselImport(BaseModel):
+    csv_text: str  # columns imo, name and optionally flag, type
+
+
+@app.post('/vessels/import')
+async def vessels_import(request: Request, data: VesselImport):
+    """Bulk insert/update vessels from CSV"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    result = await run_in_threadpool(vessels.import_csv, data.csv_text)
+    result['total'] = vessels.count()
+    return result
+
+
+@app.get('/vessels/search')
+def vessels_search(q: str, limit: int = 10):
+    """Vessels by name prefix, then close spellings"""
+    return {'ok': True, 'results': vessels.search(q, max(1, min(limit, 50)))}
+
+
+@app.get('/vessels/{imo}')
+def vessel_lookup(imo: int):
+    """Name and flag for an IMO number"""
+    vessel = vessels.get(imo)
+    if vessel is None:
+        return JSONResponse({'ok': False, 'error': f'Unknown vessel IMO {imo}'}, status_code=404)
+    return {'ok': True, 'vessel': vessel}
+
+
 class FinalNominationRequest(BaseModel):
     vessel_name: str
     actual_mgo_tons: str
@@ -706,10 +2983,76 @@ class FinalNominationRequest(BaseModel):
     bunker_date: str
 
 
+def render_final_nomination(nom_data):
+    """Patch the base of the earlier nomination with the final figures and convert it.
+
+    Returns (final_path, timing) or (None, reason) when there is nothing to patch.
+    """
+    mgo_tons = str(nom_data.actual_mgo_tons or '0').strip() or '0'
+    ifo_tons = str(nom_data.actual_ifo_tons or '0').strip() or '0'
+    kind = nomination_kind(mgo_tons, ifo_tons)
+    if kind is None:
+        return None, 'No products in final nomination'
+    supply_dates = _iso_to_supply_date(nom_data.bunker_date)
+    bunker_date = get_bunker_date(supply_dates)
+    base = find_rendered(nom_data.vessel_name, bunker_date)
+    if base is None:
+        return None, 'No earlier nomination found for this vessel'
+    if base['template'] != nomination_templates()[kind]:
+        return None, f'Earlier nomination used a different product mix than {kind.upper()}'
+    if not os.path.exists(base['path']):
+        return None, 'Earlier nomination is no longer available'
+
+    reference = bunker_date.strftime('%Y%m%d') + '-NOM-' + base['baked']['X1_VSLN'].replace(' ', '_')
+    final = {
+        'X1_MQ': mgo_tons,
+        'X1_MP': nom_data.mgo_price - 2,
+        'X1_IQ': ifo_tons,
+        'X1_IP': nom_data.ifo_price - 2,
+        'X1_VSLSD': supply_dates,
+        'X1_DATE': bunker_date - timedelta(days=10),
+        'X1_RN': reference,
+    }
+    values = dict(base['values'])
+    changed = [k for k, v in final.items() if k in values and values[k] != str(v)]
+    values.update({k: v for k, v in final.items() if k in values})
+    remaining = {k: v for k, v in values.items() if k not in base['baked']}
+
+    out_path = finished_path(f'{reference}-FINAL.docx')
+    started = time.monotonic()
+    with span('render.pass', step='final', changed=len(changed)):
+        replace_strings_in_docx(base['path'], out_path, remaining, 1)
+    patched = time.monotonic()
+    final_path = convert_docx_to_pdf(out_path, finished_path(f'{reference}-FINAL.pdf'), LIBREOFFICE_PATH)
+    converted = time.monotonic()
+    if final_path.endswith('.pdf'):
+        delete_file(out_path)
+
+    timing = {
+        'patch_ms': round((patched - started) * 1000, 1),
+        'convert_ms': round((converted - patched) * 1000, 1),
+        'original_render_ms': base['render_ms'],
+        'changed_fields': changed,
+    }
+    print(f"[FINAL] {reference}: patch {timing['patch_ms']} ms, convert {timing['convert_ms']} ms "
+          f"(original render {timing['original_render_ms']} ms), changed {changed}")
+    return final_path, timing
+
+
 @app.post('/final-nomination')
 async def final_nomination(nom_data: FinalNominationRequest):
     """Generate final nomination with actual quantities and send email with PDF"""
     try:
+        try:
+            # python-docx and soffice block; keep them off the event loop
+            final_path, timing = await run_in_threadpool(render_final_nomination, nom_data)
+        except Exception as e:
+            # The text email still goes out without the PDF
+            final_path, timing = None, f'PDF generation failed: {e}'
+        files = [final_path] if final_path else []
+        if not files:
+            print(f"[FINAL] No PDF for {nom_data.vessel_name}: {timing}")
+
         email_body = f"""Dear Simple Fuel FZCO,
 
 Please find our final nomination:
@@ -725,23 +3068,144 @@ Best regards"""
         
         email_subject = f"FINAL NOMINATION - {nom_data.vessel_name}"
         
-        send_email(
-            recipients=[PEN_EMAIL],
-            subject=email_subject,
-            body=email_body,
-            attachments=[]
-        )
+        stages = await run_stages_async({
+            'email': (send_email_async(recipients=[PEN_EMAIL], subject=email_subject, body=email_body, attachments=files, kind='final_nomination'), EMAIL_TIMEOUT),
+            's3': (upload_files_to_s3_async(files), S3_TIMEOUT),
+            'ledger': (lambda: write_ledger({'kind': 'final_nomination', 'vessel_name': nom_data.vessel_name, 'files': [os.path.basename(p) for p in files]}), LEDGER_TIMEOUT),
+        })
+        if not stages['email']['ok']:
+            raise RuntimeError(stages['email']['error'])
         
         return {
             'ok': True,
             'message': 'Final nomination sent successfully',
-            'data': nom_data.dict()
+            'data': nom_data.dict(),
+            'local_files': files,
+            's3_files': stages['s3']['result'] or [],
+            'filename': os.path.basename(final_path) if final_path else None,
+            'timing': timing if final_path else None,
+            'warning': None if final_path else timing,
+            'stages': stages,
         }
     except Exception as e:
         return {'ok': False, 'error': str(e), 'message': f'Failed to send: {str(e)}'}
 
 
+class ProfilingRequest(BaseModel):
+    count: int = 0  # profile the next N requests
+    request_id: str | None = None  # or the request sent with this X-Request-ID
+    mode: str = 'cprofile'  # 'cprofile' (.prof) or 'sampling' (collapsed stacks)
+
+
+@app.get('/admin/profiling')
+async def profiling_status(request: Request):
+    """Pending profiling triggers and captured profiles"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    with _profiling_lock:
+        pending = {'remaining': _profiling_state['remaining'], 'request_ids': sorted(_profiling_state['request_ids']), 'mode': _profiling_state['mode']}
+    return {'ok': True, 'enabled': PROFILING, 'pending': pending, 'profiles': list_profiles()}
+
+
+@app.post('/admin/profiling')
+async def arm_profiling(options: ProfilingRequest, request: Request):
+    """Profile the next N requests and/or one specific request id"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    if not PROFILING:
+        return {'ok': False, 'error': 'Profiling is disabled, start the API with PROFILING=1'}
+    if options.mode not in PROFILE_MODES:
+        return {'ok': False, 'error': f'Unknown mode: {options.mode}'}
+    with _profiling_lock:
+        _profiling_state['remaining'] = max(0, options.count)
+        _profiling_state['mode'] = options.mode
+        if options.request_id:
+            _profiling_state['request_ids'].add(options.request_id)
+    return {'ok': True, 'armed': options.dict()}
+
+
+@app.get('/admin/profiling/{name}')
+async def download_profile(name: str, request: Request):
+    """Download a captured .prof or .collapsed file"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    if not name.endswith(('.prof', '.collapsed')) or not os.path.exists(path):
+        return JSONResponse({'ok': False, 'error': 'Profile not found'}, status_code=404)
+    return FileResponse(path, media_type='application/octet-stream', filename=os.path.basename(name))
+
+
+@app.get('/admin/traces')
+async def traces_slowest(request: Request, limit: int = 20, minutes: float | None = None, path: str | None = None):
+    """Slowest recent traces, spans included"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    since = time.time() - minutes * 60 if minutes else None
+    traces = await run_in_threadpool(slowest_traces, max(1, min(limit, 200)), since, path)
+    return {'ok': True, 'tracing': TRACING, 'traces': traces}
+
+
+@app.get('/admin/traces/{trace_id}')
+async def trace_detail(trace_id: str, request: Request):
+    """One trace by correlation id"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    found = await run_in_threadpool(lambda: next((t for t in read_traces() if t['trace_id'] == trace_id), None))
+    if found is None:
+        return JSONResponse({'ok': False, 'error': 'Trace not found'}, status_code=404)
+    return {'ok': True, 'trace': found}
+
+
+@app.get('/admin/storage')
+async def storage_status(request: Request):
+    """File count and size of finished_noms per shard"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    shards = {}
+    for path in iter_finished():
+        shard = os.path.relpath(os.path.dirname(path), FINISHED_DIR)
+        entry = shards.setdefault(shard, {'files': 0, 'bytes': 0})
+        entry['files'] += 1
+        entry['bytes'] += os.path.getsize(path)
+    return {'ok': True, 'sharded': STORAGE_SHARDED, 'shards': shards}
+
+
+@app.post('/admin/storage/cleanup')
+async def storage_cleanup(request: Request):
+    """Run a janitor pass now"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    return {'ok': True, 'removed': await run_in_threadpool(run_janitor)}
+
+
+@app.post('/admin/storage/migrate')
+async def storage_migrate(request: Request):
+    """Move files from the old flat layout into shards"""
+    if not _admin_allowed(request):
+        return JSONResponse({'ok': False, 'error': 'Forbidden'}, status_code=403)
+    moved = await run_in_threadpool(migrate_finished)
+    return {'ok': True, 'moved': moved}
+
+
 if __name__ == '__main__':
+    if '--migrate-storage' in sys.argv:
+        moved = migrate_finished()
+        print(f'Moved {len(moved)} files into shards')
+        sys.exit(0)
+    if '--import-vessels' in sys.argv:
+        with open(sys.argv[sys.argv.index('--import-vessels') + 1], encoding='utf-8') as f:
+            result = vessels.import_csv(f.read())
+        print(f"Imported {result['imported']} vessels, skipped {result['skipped']}")
+        for error in result['errors']:
+            print(error)
+        sys.exit(0)
+    if '--statement' in sys.argv:
+        # python app/main.py --statement invoices.csv [company name]
+        args = sys.argv[sys.argv.index('--statement') + 1:]
+        with open(args[0], encoding='utf-8') as f:
+            result = build_statement(invoice_lines_from_csv(f.read()), args[1] if len(args) > 1 else None)
+        print(render_statement(result, args[1] if len(args) > 1 else None))
+        sys.exit(0)
     import uvicorn
     uvicorn.run(app, host='0.0.0.0', port=8000)
 
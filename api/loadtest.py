@@ -0,0 +1,617 @@
+"""Local load testing for the nomination API.
+
+Two parts:
+
+  python loadtest.py stubs [--port 9100]
+      Runs a stand-in for the Gmail API and S3 on one local HTTP server and
+      prints the environment to start the API with, e.g.
+
+        GMAIL_API_URL=http://127.0.0.1:9100/ DISABLE_EMAIL=0
+        S3_BUCKET=loadtest S3_ENDPOINT_URL=http://127.0.0.1:9100
+        AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test
+
+      Sent messages and uploaded objects are only recorded, nothing leaves the
+      machine. GET /_stub/stats shows what was received.
+
+  python loadtest.py run --target http://127.0.0.1:8000 --rps 10 --duration 60
+      Replays a mix of /endpoint1, /generate-invoice and /download traffic at a
+      fixed request rate and reports throughput, error rate and latency
+      percentiles per endpoint. Latency is measured from the moment a request
+      was scheduled, so a saturated server cannot hide queueing delay.
+
+  python loadtest.py bench-io --concurrency 10,100,500 --memory-mb 300
+      Compares the sync Gmail/S3 clients (one thread per send/upload) with the
+      async ones (ASYNC_IO=1) against the stubs. Every mode and concurrency runs
+      in a fresh process, which reports throughput, latency, peak RSS and
+      threads; the summary picks the best setting of each mode that stays
+      within the memory budget.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# ---------------- Gmail / S3 stand-ins ----------------
+class StubState:
+    def __init__(self, gmail_latency=0.0, s3_latency=0.0, keep_objects=False):
+        self.gmail_latency = gmail_latency
+        self.s3_latency = s3_latency
+        self.keep_objects = keep_objects
+        self.lock = threading.Lock()
+        self.messages = []
+        self.objects = {}  # (bucket, key) -> bytes, or size when not kept
+        self.upload_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'messages_sent': len(self.messages),
+                'attachments_sent': sum(m['attachments'] for m in self.messages),
+                'objects_uploaded': len(self.objects),
+                'bytes_uploaded': self.upload_bytes,
+                'last_messages': self.messages[-10:],
+            }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None  # set by run_stubs
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _path(self):
+        return self.path.split('?', 1)[0]
+
+    def do_GET(self):
+        path = self._path()
+        if path == '/_stub/stats':
+            return self._send(200, self.state.stats())
+        return self._s3_get(path)
+
+    def do_HEAD(self):
+        return self._s3_get(self._path())
+
+    def do_POST(self):
+        path = self._path()
+        body = self._read_body()
+        if path.startswith('/gmail/v1/users/') and path.endswith('/messages/send'):
+            return self._gmail_send(body)
+        return self._send(404, {'error': f'Unknown stub path {path}'})
+
+    def do_PUT(self):
+        path = self._path()
+        body = self._read_body()
+        bucket, _, key = path.lstrip('/').partition('/')
+        if not bucket or not key:
+            return self._send(400, b'', 'application/xml')
+        time.sleep(self.state.s3_latency)
+        size = int(self.headers.get('x-amz-decoded-content-length') or len(body))
+        with self.state.lock:
+            self.state.objects[(bucket, key)] = body if self.state.keep_objects else size
+            self.state.upload_bytes += size
+        return self._send(200, b'', 'application/xml', {'ETag': f'"{uuid.uuid4().hex}"'})
+
+    def _s3_get(self, path):
+        bucket, _, key = path.lstrip('/').partition('/')
+        with self.state.lock:
+            stored = self.state.objects.get((bucket, key))
+        if stored is None:
+            return self._send(404, b'<Error><Code>NoSuchKey</Code></Error>', 'application/xml')
+        body = stored if isinstance(stored, bytes) else b''
+        return self._send(200, body, 'application/octet-stream')
+
+    def _gmail_send(self, body):
+        time.sleep(self.state.gmail_latency)
+        try:
+            raw = json.loads(body)['raw']
+            message = message_from_bytes(base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4)))
+        except Exception as e:
+            return self._send(400, {'error': {'code': 400, 'message': f'Invalid message: {e}'}})
+        attachments = sum(1 for part in message.walk() if part.get_filename())
+        record = {
+            'id': uuid.uuid4().hex[:16],
+            'to': message.get('To'),
+            'subject': message.get('Subject'),
+            'attachments': attachments,
+            'bytes': len(raw),
+        }
+        with self.state.lock:
+            self.state.messages.append(record)
+        return self._send(200, {'id': record['id'], 'threadId': record['id'], 'labelIds': ['SENT']})
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # hundreds of clients connect at once in bench-io
+
+
+def run_stubs(args):
+    StubHandler.state = StubState(args.gmail_latency, args.s3_latency, args.keep_objects)
+    server = StubServer((args.host, args.port), StubHandler)
+    base = f'http://{args.host}:{args.port}'
+    print(f'Gmail/S3 stubs listening on {base}')
+    print('\nStart the API with:\n')
+    print(f'  GMAIL_API_URL={base}/ DISABLE_EMAIL=0 \\')
+    print(f'  S3_BUCKET=loadtest S3_ENDPOINT_URL={base} \\')
+    print('  AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test \\')
+    print('  python -m uvicorn app.main:app --port 8000')
+    print(f'\nStats: {base}/_stub/stats')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(StubHandler.state.stats(), indent=2))
+
+
+# ---------------- Load generator ----------------
+VESSEL_WORDS = ['OCEAN', 'STAR', 'PACIFIC', 'GLORY', 'SAPPHIRE', 'EAGLE', 'HORIZON', 'PEARL', 'TRADER', 'SPIRIT']
+PORTS = ['Fujairah', 'Khor Fakkan', 'Jebel Ali', 'Sohar']
+CURRENCIES = ['USD', 'USD', 'USD', 'AED', 'EUR']
+
+
+def random_vessel(rng):
+    return f'{rng.choice(VESSEL_WORDS)} {rng.choice(VESSEL_WORDS)} {rng.randint(1, 99)}'
+
+
+def random_tons(rng):
+    # Mostly single-product stems, some both
+    mix = rng.random()
+    mgo = str(rng.choice([50, 100, 150, 200, 300])) if mix < 0.7 else '0'
+    ifo = str(rng.choice([300, 500, 800, 1200])) if mix > 0.5 else '0'
+    if mgo == '0' and ifo == '0':
+        mgo = '100'
+    return mgo, ifo
+
+
+def random_supply_date(rng):
+    day = date.today() + timedelta(days=rng.randint(3, 30))
+    return day.strftime('%d.%m.%Y')
+
+
+def nomination_payload(rng):
+    mgo, ifo = random_tons(rng)
+    return {
+        'vessel_name': random_vessel(rng),
+        'vessel_imo': rng.randint(9000000, 9999999),
+        'vessel_port': rng.choice(PORTS),
+        'mgo_tons': mgo,
+        'mgo_price': round(rng.uniform(650, 800), 2),
+        'ifo_tons': ifo,
+        'ifo_price': round(rng.uniform(420, 560), 2),
+        'vessel_supply_date': random_supply_date(rng),
+        'vessel_trader': 'Load Test',
+        'vessel_agent': 'Load Test Agency',
+    }
+
+
+def invoice_payload(rng):
+    mgo, ifo = random_tons(rng)
+    currency = rng.choice(CURRENCIES)
+    return {
+        'vessel_name': random_vessel(rng),
+        'vessel_imo': rng.randint(9000000, 9999999),
+        'vessel_flag': rng.choice(['Panama', 'Liberia', 'Marshall Islands']),
+        'vessel_port': rng.choice(PORTS),
+        'bdn_numbers': str(rng.randint(10000, 99999)),
+        'mgo_tons': mgo,
+        'mgo_price': round(rng.uniform(650, 800), 2),
+        'ifo_tons': ifo,
+        'ifo_price': round(rng.uniform(420, 560), 2),
+        'supply_date': random_supply_date(rng),
+        'currency': currency,
+        'exchange_rate': {'USD': 1.0, 'AED': 3.6725, 'EUR': 0.92}[currency],
+    }
+
+
+class LoadRun:
+    def __init__(self, target, timeout):
+        self.target = target.rstrip('/')
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.results = {}  # endpoint -> list of (latency, ok, error)
+        self.filenames = []
+
+    def _request(self, method, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.target + path, data=data, method=method)
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.status, response.read()
+
+    def _remember_files(self, body):
+        names = [name.replace('\\', '/').rsplit('/', 1)[-1] for name in body.get('local_files') or []]
+        if names:
+            with self.lock:
+                self.filenames.extend(names)
+                del self.filenames[:-500]
+
+    def call(self, endpoint, rng):
+        """Returns (ok, error) for one request"""
+        if endpoint == 'endpoint1':
+            _, raw = self._request('POST', '/endpoint1', nomination_payload(rng))
+            body = json.loads(raw)
+            self._remember_files(body)
+            return bool(body.get('ok')), body.get('error')
+        if endpoint == 'generate-invoice':
+            _, raw = self._request('POST', '/generate-invoice', invoice_payload(rng))
+            body = json.loads(raw)
+            self._remember_files(body)
+            return bool(body.get('ok')), body.get('error')
+        if endpoint == 'download':
+            with self.lock:
+                name = rng.choice(self.filenames) if self.filenames else None
+            if name is None:
+                return False, 'no generated files to download yet'
+            # A missing file is a 404, raised as HTTPError and counted by run_one
+            status, _ = self._request('GET', f'/download/{name}')
+            return status == 200, None if status == 200 else f'HTTP {status}'
+        raise ValueError(f'Unknown endpoint: {endpoint}')
+
+    def run_one(self, endpoint, scheduled, rng):
+        try:
+            ok, error = self.call(endpoint, rng)
+        except urllib.error.HTTPError as e:
+            ok, error = False, f'HTTP {e.code}'
+        except Exception as e:
+            ok, error = False, f'{type(e).__name__}: {e}'
+        latency = time.monotonic() - scheduled
+        with self.lock:
+            self.results.setdefault(endpoint, []).append((latency, ok, error))
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {'endpoint1', 'generate-invoice', 'download'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f'Unknown endpoints in mix: {", ".join(sorted(unknown))}')
+    return mix
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(results, elapsed):
+    rows = {}
+    everything = []
+    for endpoint, samples in sorted(results.items()):
+        everything.extend(samples)
+        rows[endpoint] = _summary_row(samples, elapsed)
+    rows['TOTAL'] = _summary_row(everything, elapsed)
+    return rows
+
+
+def _summary_row(samples, elapsed):
+    latencies = sorted(s[0] * 1000 for s in samples)
+    errors = [s for s in samples if not s[1]]
+    return {
+        'requests': len(samples),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        'error_rate': round(len(errors) / len(samples), 4) if samples else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p90_ms': round(percentile(latencies, 90), 1),
+        'p95_ms': round(percentile(latencies, 95), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'max_ms': round(latencies[-1], 1) if latencies else 0.0,
+        'sample_errors': sorted({str(s[2]) for s in errors})[:3],
+    }
+
+
+def print_summary(rows, elapsed):
+    print(f'\nCompleted in {elapsed:.1f}s\n')
+    header = f"{'endpoint':<18}{'reqs':>7}{'rps':>8}{'err%':>8}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, row in rows.items():
+        print(
+            f"{name:<18}{row['requests']:>7}{row['throughput_rps']:>8.2f}{row['error_rate'] * 100:>7.1f}%"
+            f"{row['p50_ms']:>9.1f}{row['p90_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}"
+        )
+    for name, row in rows.items():
+        if name != 'TOTAL' and row['sample_errors']:
+            print(f"\n{name} errors: {'; '.join(row['sample_errors'])}")
+
+
+def run_load(args):
+    rng = random.Random(args.seed)
+    run = LoadRun(args.target, args.timeout)
+    endpoints = list(args.mix)
+    weights = [args.mix[e] for e in endpoints]
+
+    # Warm up so /download has something to fetch
+    print(f'Warming up against {args.target} ...')
+    for endpoint in ('endpoint1', 'generate-invoice'):
+        try:
+            run.call(endpoint, rng)
+        except Exception as e:
+            print(f'Warm-up {endpoint} failed: {e}')
+
+    total = int(args.rps * args.duration)
+    print(f'Sending {total} requests at {args.rps} rps for {args.duration}s, mix {args.mix}')
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+    started = time.monotonic()
+    for i in range(total):
+        scheduled = started + i / args.rps
+        delay = scheduled - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        endpoint = rng.choices(endpoints, weights)[0]
+        pool.submit(run.run_one, endpoint, scheduled, random.Random(rng.random()))
+    pool.shutdown(wait=True)
+    elapsed = time.monotonic() - started
+
+    rows = summarize(run.results, elapsed)
+    print_summary(rows, elapsed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'elapsed_s': round(elapsed, 2), 'rps_target': args.rps, 'mix': args.mix, 'results': rows}, f, indent=2)
+        print(f'\nResults written to {args.json}')
+
+
+# ---------------- Sync vs async Gmail/S3 ----------------
+def _rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_bench_worker(args):
+    """One mode/op/concurrency in this process; prints a JSON result line"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+    import main as api  # reads ASYNC_IO and the stub endpoints from the environment
+
+    attachment = os.path.join(tempfile.mkdtemp(prefix='bench-io-'), 'bench.pdf')
+    with open(attachment, 'wb') as f:
+        f.write(os.urandom(args.attachment_kb * 1024))
+
+    peak = {'rss_kb': _rss_kb(), 'threads': threading.active_count()}
+    baseline_kb = peak['rss_kb']
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.02):
+            peak['rss_kb'] = max(peak['rss_kb'], _rss_kb())
+            peak['threads'] = max(peak['threads'], threading.active_count())
+
+    threading.Thread(target=sample, daemon=True).start()
+    latencies, errors = [], []
+    if args.op == 's3':
+        api.prepare_s3_async()  # as the API does at startup
+
+    def record(started, error):
+        latencies.append(time.monotonic() - started)
+        if error:
+            errors.append(error)
+
+    started_all = time.monotonic()
+    if args.mode == 'async':
+        async def one(semaphore):
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    if args.op == 'email':
+                        await api.deliver_email_async(['bench@example.com'], 'bench-io', 'benchmark', [attachment])
+                    elif not await api.upload_files_to_s3_async([attachment]):
+                        raise RuntimeError('upload failed')
+                    record(started, None)
+                except Exception as e:
+                    record(started, f'{type(e).__name__}: {e}')
+
+        async def run_all():
+            semaphore = asyncio.Semaphore(args.concurrency)
+            await asyncio.gather(*(one(semaphore) for _ in range(args.total)))
+            await api.close_async_http()
+
+        asyncio.run(run_all())
+    else:
+        def one():
+            started = time.monotonic()
+            try:
+                if args.op == 'email':
+                    api.deliver_email(['bench@example.com'], 'bench-io', 'benchmark', [attachment])
+                elif not api.upload_files_to_s3([attachment]):
+                    raise RuntimeError('upload failed')
+                record(started, None)
+            except Exception as e:
+                record(started, f'{type(e).__name__}: {e}')
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for _ in range(args.total):
+                pool.submit(one)
+    elapsed = time.monotonic() - started_all
+    done.set()
+
+    ordered = sorted(l * 1000 for l in latencies)
+    print(json.dumps({
+        'op': args.op,
+        'mode': args.mode,
+        'concurrency': args.concurrency,
+        'total': args.total,
+        'elapsed_s': round(elapsed, 2),
+        'ops_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(ordered, 50), 1),
+        'p95_ms': round(percentile(ordered, 95), 1),
+        'errors': len(errors),
+        'sample_errors': sorted(set(errors))[:3],
+        'baseline_rss_mb': round(baseline_kb / 1024, 1),
+        'peak_rss_mb': round(peak['rss_kb'] / 1024, 1),
+        'peak_threads': peak['threads'],
+    }))
+
+
+def run_bench_io(args):
+    StubHandler.state = StubState(args.gmail_latency, args.s3_latency)
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    workdir = tempfile.mkdtemp(prefix='bench-io-')
+    print(f'Stubs on {base} (Gmail +{args.gmail_latency}s, S3 +{args.s3_latency}s), {args.total} ops per run\n')
+
+    rows = []
+    header = f"{'op':<7}{'mode':<7}{'conc':>6}{'ops/s':>9}{'p50':>9}{'p95':>9}{'err':>6}{'rss MB':>9}{'threads':>9}"
+    print(header)
+    print('-' * len(header))
+    for op in args.ops:
+        for mode in args.modes:
+            for concurrency in args.concurrency:
+                env = {
+                    **os.environ,
+                    'ASYNC_IO': '1' if mode == 'async' else '0',
+                    'ASYNC_MAX_CONNECTIONS': str(max(concurrency, 10)),
+                    'ASYNC_KEEPALIVE': str(max(concurrency, 10)),
+                    'GMAIL_API_URL': f'{base}/',
+                    'DISABLE_EMAIL': '0',
+                    'TOKEN_FILE': os.path.join(workdir, 'no-token.json'),
+                    'S3_BUCKET': 'loadtest',
+                    'S3_ENDPOINT_URL': base,
+                    'AWS_ACCESS_KEY_ID': 'test',
+                    'AWS_SECRET_ACCESS_KEY': 'test',
+                    'SHARED_STATE': 'memory',
+                    'VESSEL_DB': os.path.join(workdir, 'vessels.db'),
+                    'TRACING': '0',
+                }
+                command = [
+                    sys.executable, os.path.abspath(__file__), 'bench-worker', '--op', op, '--mode', mode,
+                    '--concurrency', str(concurrency), '--total', str(args.total), '--attachment-kb', str(args.attachment_kb),
+                ]
+                proc = subprocess.run(command, env=env, capture_output=True, text=True)
+                try:
+                    row = json.loads(proc.stdout.strip().splitlines()[-1])
+                except (IndexError, ValueError):
+                    print(f'{op:<7}{mode:<7}{concurrency:>6}  failed: {proc.stderr.strip().splitlines()[-1:]}')
+                    continue
+                rows.append(row)
+                print(
+                    f"{op:<7}{mode:<7}{concurrency:>6}{row['ops_per_s']:>9.1f}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+                    f"{row['errors']:>6}{row['peak_rss_mb']:>9.1f}{row['peak_threads']:>9}"
+                )
+    server.shutdown()
+
+    if args.memory_mb:
+        print(f'\nBest within {args.memory_mb} MB peak RSS:')
+        for op in args.ops:
+            for mode in args.modes:
+                fitting = [r for r in rows if r['op'] == op and r['mode'] == mode
+                           and r['peak_rss_mb'] <= args.memory_mb and not r['errors']]
+                if not fitting:
+                    print(f'  {op:<6} {mode:<6} nothing fits')
+                    continue
+                best = max(fitting, key=lambda r: r['ops_per_s'])
+                print(f"  {op:<6} {mode:<6} concurrency {best['concurrency']}: {best['ops_per_s']} ops/s, "
+                      f"p95 {best['p95_ms']} ms, {best['peak_rss_mb']} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'memory_mb': args.memory_mb, 'results': rows}, f, indent=2)
+        print(f'\nResults written to {args.json}')
+
+
+def parse_list(value, cast=str):
+    return [cast(v.strip()) for v in value.split(',') if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local load testing for the nomination API')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    stubs = sub.add_parser('stubs', help='run the Gmail and S3 stand-ins')
+    stubs.add_argument('--host', default='127.0.0.1')
+    stubs.add_argument('--port', type=int, default=9100)
+    stubs.add_argument('--gmail-latency', type=float, default=0.0, help='seconds added to every Gmail send')
+    stubs.add_argument('--s3-latency', type=float, default=0.0, help='seconds added to every S3 upload')
+    stubs.add_argument('--keep-objects', action='store_true', help='keep uploaded bytes so they can be fetched back')
+    stubs.set_defaults(func=run_stubs)
+
+    load = sub.add_parser('run', help='replay traffic against a running API')
+    load.add_argument('--target', default='http://127.0.0.1:8000')
+    load.add_argument('--rps', type=float, default=5.0)
+    load.add_argument('--duration', type=float, default=30.0, help='seconds')
+    load.add_argument('--mix', type=parse_mix, default=parse_mix('endpoint1=5,generate-invoice=3,download=2'),
+                      help='weights, e.g. endpoint1=5,generate-invoice=3,download=2')
+    load.add_argument('--workers', type=int, default=64, help='max requests in flight')
+    load.add_argument('--timeout', type=float, default=60.0)
+    load.add_argument('--seed', type=int, default=None)
+    load.add_argument('--json', help='also write the results to this file')
+    load.set_defaults(func=run_load)
+
+    bench = sub.add_parser('bench-io', help='compare sync and async Gmail/S3 clients')
+    bench.add_argument('--ops', type=parse_list, default=['email', 's3'], help='email,s3')
+    bench.add_argument('--modes', type=parse_list, default=['sync', 'async'], help='sync,async')
+    bench.add_argument('--concurrency', type=lambda v: parse_list(v, int), default=[10, 50, 200, 500],
+                       help='sends/uploads in flight, e.g. 10,50,200,500')
+    bench.add_argument('--total', type=int, default=1000, help='operations per run')
+    bench.add_argument('--attachment-kb', type=int, default=40)
+    bench.add_argument('--gmail-latency', type=float, default=0.2)
+    bench.add_argument('--s3-latency', type=float, default=0.1)
+    bench.add_argument('--memory-mb', type=float, default=None, help='memory budget for the summary')
+    bench.add_argument('--json', help='also write the results to this file')
+    bench.set_defaults(func=run_bench_io)
+
+    worker = sub.add_parser('bench-worker', help=argparse.SUPPRESS)
+    worker.add_argument('--op', choices=['email', 's3'], required=True)
+    worker.add_argument('--mode', choices=['sync', 'async'], required=True)
+    worker.add_argument('--concurrency', type=int, required=True)
+    worker.add_argument('--total', type=int, required=True)
+    worker.add_argument('--attachment-kb', type=int, default=40)
+    worker.set_defaults(func=run_bench_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
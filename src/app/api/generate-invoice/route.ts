@@ -14,12 +14,14 @@ export async function POST(request: Request) {
       },
       body: JSON.stringify(body),
     });
+    // Correlation id of the backend trace, for /admin/traces/{id}
+    const requestId = response.headers.get("X-Request-ID");
 
     if (!response.ok) {
       const errorData = await response.json().catch(() => ({}));
       return NextResponse.json(
-        { error: errorData.message || "Failed to generate invoice" },
-        { status: response.status }
+        { error: errorData.message || "Failed to generate invoice", request_id: requestId },
+        { status: response.status, headers: requestId ? { "X-Request-ID": requestId } : {} }
       );
     }
 
@@ -34,12 +36,13 @@ export async function POST(request: Request) {
         headers: {
           "Content-Type": "application/pdf",
           "Content-Disposition": `attachment; filename="invoice-${body.vessel_name?.replace(/\s+/g, '_')}-${Date.now()}.pdf"`,
+          ...(requestId ? { "X-Request-ID": requestId } : {}),
         },
       });
     } else {
       // Return JSON response
       const data = await response.json();
-      return NextResponse.json(data);
+      return NextResponse.json(data, { headers: requestId ? { "X-Request-ID": requestId } : {} });
     }
   } catch (error) {
     console.error("Invoice generation error:", error);